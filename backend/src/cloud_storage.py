@@ -1,20 +1,58 @@
+import functools
 import io
 import os
 from pathlib import Path
 
 import yaml
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core import exceptions
 from google.cloud import storage
 import logging
 import json
 import tempfile
 from PIL import Image
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger("insta_poster_logger")
+# Connections kept open to the storage API, shared by every adapter in the process
+HTTP_POOL_SIZE = int(os.getenv("STORAGE_HTTP_POOL_SIZE", 32))
+
+
+@functools.cache
+def get_default_credentials() -> tuple:
+    """Resolve the application default credentials once per process"""
+    return google.auth.default(scopes=storage.Client.SCOPE)
+
+
+@functools.cache
+def get_authorized_session() -> AuthorizedSession:
+    """
+    Session with the default credentials, used by the storage client and for
+    raw requests to storage, with connections kept open for every adapter
+    """
+    credentials, _ = get_default_credentials()
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+
+@functools.cache
+def get_storage_client() -> storage.Client:
+    """
+    The storage client for this process, so credentials are refreshed and
+    connections set up once rather than for every adapter
+    """
+    credentials, project = get_default_credentials()
+    return storage.Client(
+        project=project, credentials=credentials, _http=get_authorized_session()
+    )
 
 
 class CloudStorageAdapter:
-    def __init__(self, bucket_name: str) -> None:
-        self.storage_client = storage.Client()
+    def __init__(self, bucket_name: str, storage_client: storage.Client = None) -> None:
+        self.storage_client = storage_client or get_storage_client()
         self.bucket_name = bucket_name
         self.bucket = self.storage_client.bucket(bucket_name)
 
@@ -153,10 +191,18 @@ class CloudStorageAdapter:
             content = json.dumps(content)
         blob.upload_from_string(data=content, content_type=f"application/{ext}")
 
-    def upload_json(self, file_path: Path, content: dict):
+    def upload_json(
+        self, file_path: Path, content: dict, if_generation_match: int = None
+    ) -> int:
+        """Upload a json blob, optionally only if its generation still matches"""
         blob = self.bucket.blob(str(file_path))
         dumped = json.dumps(content, indent=4)
-        blob.upload_from_string(data=dumped, content_type="application/json")
+        blob.upload_from_string(
+            data=dumped,
+            content_type="application/json",
+            if_generation_match=if_generation_match,
+        )
+        return blob.generation
 
 
     def download_json_blob(self, blob_path: Path) -> dict:
@@ -166,6 +212,60 @@ class CloudStorageAdapter:
             blob_str = json.loads(blob_str)
         return blob_str
 
+    def move_blob(self, blob_path: Path, destination_path: Path):
+        """Server-side copy then delete, the data never passes through us"""
+        blob = self.bucket.blob(str(blob_path))
+        self.bucket.copy_blob(blob, self.bucket, str(destination_path))
+        blob.delete()
+
+    def create_resumable_session(self, file_path: Path, content_type: str, size: int) -> str:
+        """Start a resumable upload of 'size' bytes, returns the session url"""
+        blob = self.bucket.blob(str(file_path))
+        return blob.create_resumable_upload_session(
+            content_type=content_type, size=size, checksum=None
+        )
+
+    @staticmethod
+    def get_committed_offset(response, size: int) -> int:
+        if response.status_code in (200, 201):
+            return size
+        if response.status_code != 308:
+            # e.g. NotFound or Gone once the session has expired
+            raise exceptions.from_http_response(response)
+        # e.g. 'bytes=0-1048575', missing when nothing is committed yet
+        committed = response.headers.get("Range")
+        return int(committed.split("-")[1]) + 1 if committed else 0
+
+    def upload_chunk(self, session_url: str, data: bytes, offset: int, size: int) -> int:
+        """Send bytes from 'offset' of a resumable upload, returns the new offset"""
+        end = offset + len(data) - 1
+        response = get_authorized_session().put(
+            session_url,
+            data=data,
+            headers={"Content-Range": f"bytes {offset}-{end}/{size}"},
+        )
+        return self.get_committed_offset(response, size)
+
+    def get_resumable_offset(self, session_url: str, size: int) -> int:
+        """Ask storage how much of a resumable upload it has committed"""
+        response = get_authorized_session().put(
+            session_url, headers={"Content-Range": f"bytes */{size}"}
+        )
+        return self.get_committed_offset(response, size)
+
+    def get_blob_generation(self, blob_path: Path) -> int:
+        """Generation of a blob from its metadata, 0 if it does not exist"""
+        blob = self.bucket.get_blob(str(blob_path))
+        return blob.generation if blob else 0
+
+    def download_json_blob_with_generation(self, blob_path: Path) -> tuple[dict, int]:
+        """Download a json blob with its generation, generation is 0 if missing"""
+        blob = self.bucket.get_blob(str(blob_path))
+        if blob is None:
+            return None, 0
+        blob_str = blob.download_as_bytes()
+        return json.loads(blob_str), blob.generation
+
     def download_yaml_blob(self, blob_path: Path) -> dict:
         blob = self.bucket.blob(str(blob_path))
         blob_str = blob.download_as_string()
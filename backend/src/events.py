@@ -0,0 +1,71 @@
+import asyncio
+import json
+from typing import BinaryIO, Callable
+
+MAX_QUEUED_EVENTS = 100
+
+
+class EventBroker:
+    """
+    Fans events out to every connected stream. Each stream gets its own
+    bounded queue, dropping its oldest events if it falls behind. publish() is
+    safe to call from the ingest executor's threads.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.loop = None
+
+    def subscribe(self) -> asyncio.Queue:
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=MAX_QUEUED_EVENTS)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event: dict):
+        if self.subscribers and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.put, event)
+
+    def put(self, event: dict):
+        for queue in list(self.subscribers):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+def format_event(event: dict) -> str:
+    """Server-sent event, named after the event's type"""
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+class ProgressReader:
+    """
+    File wrapper for chunked uploads, calling 'on_progress(bytes_sent)' as the
+    file is read. The next chunk is only read once the previous one has been
+    sent, so everything read before it has gone over the network.
+    """
+
+    def __init__(self, file: BinaryIO, on_progress: Callable[[int], None]):
+        self.file = file
+        self.on_progress = on_progress
+        self.bytes_read = 0
+        self.reported = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if self.bytes_read > self.reported:
+            self.reported = self.bytes_read
+            self.on_progress(self.bytes_read)
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        position = self.file.seek(offset, whence)
+        self.bytes_read = self.reported = self.file.tell()
+        return position
+
+    def __getattr__(self, name: str):
+        return getattr(self.file, name)
@@ -0,0 +1,49 @@
+import logging
+from pathlib import Path
+from typing import Callable
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from src.cloud_storage import CloudStorageAdapter
+
+COUNTER_FILE = "post_id.json"
+MAX_ALLOCATE_ATTEMPTS = 10
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class PostIdAllocator:
+    """
+    Hands out post ids from a counter stored as '{subdirectory}/post_id.json':
+
+        {"next_id": 13}
+
+    Each allocation is a read and a write conditional on the generation read,
+    retried if another upload got there first, so two uploads never get the
+    same id. The counter is seeded from 'seed' (the current max id) the first
+    time it is used.
+    """
+
+    def __init__(
+        self, gcs: CloudStorageAdapter, subdirectory: Path, seed: Callable[[], int]
+    ):
+        self.gcs = gcs
+        self.path = Path(subdirectory).joinpath(COUNTER_FILE)
+        self.seed = seed
+
+    def allocate(self) -> int:
+        for _ in range(MAX_ALLOCATE_ATTEMPTS):
+            try:
+                content, generation = self.gcs.download_json_blob_with_generation(
+                    self.path
+                )
+            except NotFound:
+                # Replaced between fetching its metadata and its contents
+                continue
+            id = content["next_id"] if content else self.seed() + 1
+            try:
+                self.gcs.upload_json(
+                    self.path, {"next_id": id + 1}, if_generation_match=generation
+                )
+                return id
+            except PreconditionFailed:
+                logger.info(f"Post id counter '{self.path}' changed, retrying...")
+        raise RuntimeError(f"Could not allocate a post id from '{self.path}'!")
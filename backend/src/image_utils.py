@@ -2,6 +2,7 @@ from pathlib import Path
 import re
 import logging
 from src.cloud_storage import CloudStorageAdapter
+from src.manifest import QueueManifest
 
 MAX_PIXEL_WIDTH = 1080
 MAX_PIXEL_HEIGHT = 1350
@@ -60,6 +61,12 @@ class PostManager:
                 file_names.append(file_name)
         return file_names
 
+    def get_queue_manifest(self, subdirectory: str) -> QueueManifest:
+        """Load the queue manifest, replaces listing the whole subdirectory"""
+        manifest = QueueManifest(self.cs, subdirectory)
+        manifest.load()
+        return manifest
+
     def get_images_to_post(self, subdirectory=None) -> list[str]:
         """Select the most recent photo/s from the bucket"""
         images_to_post = []
@@ -1,11 +1,21 @@
+import asyncio
+import functools
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import yaml
-from fastapi import FastAPI, UploadFile, Form
+from google.api_core.exceptions import GoogleAPICallError
+from fastapi import FastAPI, UploadFile, Form, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from google.cloud import storage
+from fastapi.responses import JSONResponse, StreamingResponse
+from src.cloud_storage import get_storage_client
+from src.events import EventBroker, ProgressReader, format_event
+from src.id_allocator import PostIdAllocator
 from src.image_utils import PostManager
+from src.manifest import QueueManifest
 from src.models import PostInfo
+from src.resumable import CHUNK_ALIGNMENT, MAX_CHUNK_SIZE, ResumableUploads
 import uvicorn
 
 app = FastAPI()
@@ -16,45 +26,238 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Location", "Upload-Offset", "Upload-Length"],
 )
 
 BUCKET_NAME = "{{ PROJECT_ID }}-images"
 UNPROCESSED_DIR = "test/unprocessed"
+STAGING_DIR = "test/staging"
+# Images are sent in chunks of this, with a progress event after each
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 4 * CHUNK_ALIGNMENT))
+# Threads for blocking storage calls, shared by all requests so the event loop never waits on them
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 16))
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+# Seconds the upload status is served from memory before checking the queue's change marker
+STATUS_TTL = float(os.getenv("STATUS_TTL", 5))
+upload_status = {"data": None, "marker": None, "checked_at": 0.0}
+events = EventBroker()
 # app.upload_status = {"data": "idle"}  # idle, uploading, complete
 
 @app.get("/api/")
 async def root():
     return {"message": "Welcome to Instagram Poster!"}
 
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the ingest executor and wait for it without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ingest_executor, functools.partial(func, *args, **kwargs))
+
+
+def allocate_post_id() -> int:
+    pm = PostManager(BUCKET_NAME)
+    allocator = PostIdAllocator(
+        pm.cs, UNPROCESSED_DIR, seed=lambda: pm.get_queue_manifest(UNPROCESSED_DIR).get_max_id()
+    )
+    return allocator.allocate()
+
+
+def invalidate_upload_status():
+    upload_status["data"] = None
+
+
+def refresh_upload_status() -> dict:
+    """Reload the status only if the queue changed since it was cached"""
+    manifest = QueueManifest(PostManager(BUCKET_NAME).cs, UNPROCESSED_DIR)
+    marker = manifest.get_change_marker()
+    if upload_status["data"] is None or marker != upload_status["marker"]:
+        manifest.load()
+        upload_status["data"] = manifest.get_max_id()
+        # Loading may rebuild the manifest, which moves the marker on itself
+        upload_status["marker"] = manifest.marker_generation or marker
+    upload_status["checked_at"] = time.monotonic()
+    return upload_status
+
+
 @app.get("/api/uploadstatus/")
 async def get_upload_status() -> dict:
-    pm = PostManager(BUCKET_NAME)
-    file_names = pm.get_file_names(UNPROCESSED_DIR)
-    ids = pm.get_image_file_ids(file_names)
-    max_id = pm.get_max_id(ids)
-    return {"data": max_id}
+    if (
+        upload_status["data"] is None
+        or time.monotonic() - upload_status["checked_at"] > STATUS_TTL
+    ):
+        await run_blocking(refresh_upload_status)
+    return {"data": upload_status["data"]}
+
+
+@app.get("/api/events/")
+async def stream_events(request: Request):
+    """
+    Server-sent events for upload progress ('file', 'config' and 'post') and
+    changes to the queue's max id ('queue'), replacing polling of the status
+    """
+    async def _stream():
+        queue = events.subscribe()
+        try:
+            max_id = (await get_upload_status())["data"]
+            yield format_event({"type": "queue", "data": max_id})
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STATUS_TTL)
+                except asyncio.TimeoutError:
+                    # Picks up posts removed by the scheduler
+                    status = await get_upload_status()
+                    if status["data"] != max_id:
+                        max_id = status["data"]
+                        yield format_event({"type": "queue", "data": max_id})
+                    else:
+                        yield ": keep-alive\n\n"
+                    continue
+                if event["type"] == "queue":
+                    max_id = event["data"]
+                yield format_event(event)
+        finally:
+            events.unsubscribe(queue)
+
+    return StreamingResponse(
+        _stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
 
 
 @app.post("/api/uploadimages/")
-async def create_files(files: list[UploadFile], caption: str = Form(...), location: str = Form(...), hashtags: str = Form(...), image_order: list[str] = Form(...)):
-    files, id = get_new_file_names(files, image_order)
+async def create_files(files: list[UploadFile], caption: str = Form(...), location: str = Form(...), hashtags: str = Form(...), image_order: list[str] = Form(...), upload_key: str = Form(None)):
+    id = await run_blocking(allocate_post_id)
+    files = get_new_file_names(files, image_order, id)
+    events.publish({"type": "post", "upload_key": upload_key, "id": id, "state": "started"})
 
     post_details = PostInfo(
         caption=caption,
         location=location,
         hashtags=hashtags.split(),
     )
-    upload_post_details(post_details, path=f"{UNPROCESSED_DIR}/{id}.yaml")
-    upload_images(files)
+    await asyncio.gather(
+        run_blocking(upload_post_details, post_details, path=f"{UNPROCESSED_DIR}/{id}.yaml", upload_key=upload_key),
+        upload_images(files, upload_key),
+    )
+    await add_post_to_queue(id, [file.filename for file in files], upload_key)
     return {"data": "Upload Complete!"}
 
 
-def get_new_file_names(files: list[UploadFile], image_order: list[str]) -> list[str]:
-    pm = PostManager(BUCKET_NAME)
-    file_names = pm.get_file_names(UNPROCESSED_DIR)
-    ids = pm.get_image_file_ids(file_names)
-    id = pm.get_max_id(ids) + 1
+@app.post("/api/uploads/")
+async def create_upload(file_name: str = Form(...), size: int = Form(...), content_type: str = Form("image/jpeg")):
+    """Start a chunked, resumable upload of one file"""
+    state = await run_blocking(get_resumable_uploads().create, file_name, size, content_type)
+    return JSONResponse(
+        {"upload_id": state["upload_id"], "offset": 0, "max_chunk_size": MAX_CHUNK_SIZE},
+        status_code=201,
+        headers={
+            "Location": f"/api/uploads/{state['upload_id']}",
+            "Upload-Offset": "0",
+            "Upload-Length": str(size),
+        },
+    )
+
+
+@app.head("/api/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str):
+    """Offset to resume an upload from"""
+    try:
+        state = await run_blocking(get_resumable_uploads().get_offset, upload_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except GoogleAPICallError as e:
+        raise HTTPException(
+            status_code=get_session_error_status(e),
+            detail=f"Storage failed the upload '{upload_id}' with {e.code}!",
+        )
+    return Response(headers={
+        "Upload-Offset": str(state["offset"]),
+        "Upload-Length": str(state["size"]),
+        "Cache-Control": "no-store",
+    })
+
+
+@app.patch("/api/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, upload_offset: int = Header(...), upload_key: str = Header(None)):
+    """Append a chunk at 'Upload-Offset', only the one chunk is held in memory"""
+    data = bytearray()
+    async for part in request.stream():
+        data.extend(part)
+        if len(data) > MAX_CHUNK_SIZE:
+            raise HTTPException(status_code=413, detail=f"Chunks can be at most {MAX_CHUNK_SIZE} bytes!")
+    try:
+        state = await run_blocking(get_resumable_uploads().write_chunk, upload_id, upload_offset, bytes(data))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except GoogleAPICallError as e:
+        raise HTTPException(
+            status_code=get_session_error_status(e),
+            detail=f"Storage failed the upload '{upload_id}' with {e.code}!",
+        )
+    events.publish({
+        "type": "file",
+        "upload_key": upload_key,
+        "file": state["file_name"],
+        "state": "committed" if state["offset"] == state["size"] else "uploading",
+        "bytes_sent": state["offset"],
+        "total": state["size"],
+    })
+    return Response(status_code=204, headers={"Upload-Offset": str(state["offset"])})
+
 
+@app.post("/api/uploadpost/")
+async def create_post_from_uploads(upload_ids: list[str] = Form(...), caption: str = Form(...), location: str = Form(...), hashtags: str = Form(...), upload_key: str = Form(None)):
+    """Queue a post made of finished chunked uploads, in the order given"""
+    uploads = get_resumable_uploads()
+    try:
+        states = await asyncio.gather(*[run_blocking(uploads.get, upload_id) for upload_id in upload_ids])
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    unfinished = [state["upload_id"] for state in states if state["offset"] != state["size"]]
+    if unfinished:
+        raise HTTPException(status_code=409, detail=f"Uploads {unfinished} are not finished!")
+
+    id = await run_blocking(allocate_post_id)
+    events.publish({"type": "post", "upload_key": upload_key, "id": id, "state": "started"})
+    file_names = [f"{id}_{i}_{state['file_name']}" for i, state in enumerate(states)]
+    post_details = PostInfo(
+        caption=caption,
+        location=location,
+        hashtags=hashtags.split(),
+    )
+    await asyncio.gather(
+        run_blocking(upload_post_details, post_details, path=f"{UNPROCESSED_DIR}/{id}.yaml", upload_key=upload_key),
+        *[
+            run_blocking(uploads.complete, state["upload_id"], Path(UNPROCESSED_DIR, file_name))
+            for state, file_name in zip(states, file_names)
+        ],
+    )
+    await add_post_to_queue(id, file_names, upload_key)
+    return {"data": "Upload Complete!"}
+
+
+def get_session_error_status(error: GoogleAPICallError) -> int:
+    """
+    404 or 410 if storage no longer knows the upload session, so the client
+    starts the upload again, otherwise 502 and the client can resume
+    """
+    return error.code if error.code in (404, 410) else 502
+
+
+def get_resumable_uploads() -> ResumableUploads:
+    return ResumableUploads(PostManager(BUCKET_NAME).cs, STAGING_DIR)
+
+
+async def add_post_to_queue(id: int, file_names: list[str], upload_key: str = None):
+    """Add an uploaded post to the manifest and tell anyone watching"""
+    manifest = QueueManifest(PostManager(BUCKET_NAME).cs, UNPROCESSED_DIR)
+    await run_blocking(manifest.add_post, id, file_names, config=f"{id}.yaml")
+    invalidate_upload_status()
+    events.publish({"type": "post", "upload_key": upload_key, "id": id, "state": "complete"})
+    events.publish({"type": "queue", "data": (await get_upload_status())["data"]})
+
+
+def get_new_file_names(files: list[UploadFile], image_order: list[str], id: int) -> list[UploadFile]:
     sorted_files = [" "] * len(files)
     for file in files:
         i = image_order.index(file.filename)
@@ -63,12 +266,11 @@ def get_new_file_names(files: list[UploadFile], image_order: list[str]) -> list[
     for i, file in enumerate(sorted_files):
         file.filename = f"{id}_{i}_{file.filename}"
 
-    return sorted_files, id
+    return sorted_files
 
 
-def upload_post_details(post_info: PostInfo, path: str):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
+def upload_post_details(post_info: PostInfo, path: str, upload_key: str = None):
+    bucket = get_storage_client().bucket(BUCKET_NAME)
     file_path = Path(path)
 
     blob = bucket.blob(str(file_path))
@@ -76,16 +278,46 @@ def upload_post_details(post_info: PostInfo, path: str):
     content = yaml.dump(dict(post_info), indent=4)
 
     blob.upload_from_string(data=content, content_type=f"application/{ext}")
+    events.publish({"type": "config", "upload_key": upload_key, "file": file_path.name, "state": "written"})
 
     return True
 
 
-def upload_images(files: list[UploadFile]):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    for file in files:
-        blob = bucket.blob(f"{UNPROCESSED_DIR}/{file.filename}")
-        blob.upload_from_file(file.file, content_type=f'image/{Path(file.filename).suffix}')
+def upload_image(file: UploadFile, upload_key: str = None):
+    file.file.seek(0, os.SEEK_END)
+    total = file.file.tell()
+    file.file.seek(0)
+
+    def _on_progress(bytes_sent: int):
+        events.publish({
+            "type": "file",
+            "upload_key": upload_key,
+            "file": file.filename,
+            "state": "uploading",
+            "bytes_sent": bytes_sent,
+            "total": total,
+        })
+
+    blob = get_storage_client().bucket(BUCKET_NAME).blob(f"{UNPROCESSED_DIR}/{file.filename}")
+    # With no size given even small files are sent as a chunked resumable upload
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.upload_from_file(
+        ProgressReader(file.file, _on_progress),
+        content_type=f"image/{Path(file.filename).suffix.lstrip('.')}",
+    )
+    events.publish({
+        "type": "file",
+        "upload_key": upload_key,
+        "file": file.filename,
+        "state": "committed",
+        "bytes_sent": total,
+        "total": total,
+    })
+
+
+async def upload_images(files: list[UploadFile], upload_key: str = None):
+    """Stream every file to the bucket at once, bounded by the ingest executor"""
+    await asyncio.gather(*[run_blocking(upload_image, file, upload_key) for file in files])
     return True
 
 if __name__ == "__main__":
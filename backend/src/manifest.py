@@ -0,0 +1,153 @@
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Callable
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from src.cloud_storage import CloudStorageAdapter
+
+MANIFEST_FILE = "manifest.json"
+# Rewritten on every change to the queue, its generation tells readers something changed
+CHANGE_MARKER_FILE = "queue_changed.json"
+MANIFEST_IMAGE_EXTS = [".jpg", ".jpeg", ".png"]
+MANIFEST_CONFIG_EXTS = [".yaml", ".json"]
+MAX_UPDATE_ATTEMPTS = 5
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class QueueManifest:
+    """
+    Small json index of the posts waiting in a queue directory, stored next to
+    the images as '{subdirectory}/manifest.json':
+
+        {"posts": {"12": {"images": ["12_0_a.jpg"], "config": "12.yaml"}}}
+
+    Uploads and deletes update it in place so finding the next post or the max
+    id is a single read rather than a listing of the whole directory. If the
+    manifest is missing it is rebuilt from a listing, rebuild() can also be
+    called to pick up anything copied into the bucket directly.
+    """
+
+    def __init__(self, gcs: CloudStorageAdapter, subdirectory: Path):
+        self.gcs = gcs
+        self.subdirectory = Path(subdirectory)
+        self.path = self.subdirectory.joinpath(MANIFEST_FILE)
+        self.marker_path = self.subdirectory.joinpath(CHANGE_MARKER_FILE)
+        self.num_id_pattern = re.compile(r"^[0-9]+")
+        self.posts = {}
+        self.generation = 0
+        # Generation of the change marker last written here, if any
+        self.marker_generation = None
+
+    def read(self) -> dict:
+        """Read the manifest and its generation, None if it does not exist yet"""
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            try:
+                content, self.generation = self.gcs.download_json_blob_with_generation(
+                    self.path
+                )
+                return content
+            except NotFound:
+                # Replaced between fetching its metadata and its contents
+                continue
+        raise RuntimeError(f"Could not read queue manifest '{self.path}'!")
+
+    def load(self) -> dict:
+        content = self.read()
+        if content is None:
+            logger.info(f"Rebuilding queue manifest '{self.path}' from listing...")
+            self.rebuild()
+        else:
+            self.posts = content["posts"]
+        return self.posts
+
+    def rebuild(self) -> dict:
+        """
+        Rebuild the manifest from a full listing of the queue directory, only
+        writing it back if it differs from the stored one
+        """
+        posts = {}
+        for file in self.gcs.list_blobs(prefix=str(self.subdirectory)):
+            file_name = Path(file).name
+            num_id = self.num_id_pattern.search(file_name)
+            if not num_id:
+                continue
+            post = posts.setdefault(num_id.group(), {"images": [], "config": None})
+            suffix = Path(file_name).suffix.lower()
+            if suffix in MANIFEST_IMAGE_EXTS:
+                post["images"].append(file_name)
+            elif file_name in [f"{num_id.group()}{ext}" for ext in MANIFEST_CONFIG_EXTS]:
+                post["config"] = file_name
+
+        for post in posts.values():
+            post["images"].sort()
+        posts = {id: post for id, post in posts.items() if post["images"]}
+        if self.generation and posts == self.posts:
+            return self.posts
+        self.posts = posts
+        self.save()
+        return self.posts
+
+    def save(self):
+        try:
+            self.generation = self.gcs.upload_json(
+                self.path, {"posts": self.posts}, if_generation_match=self.generation
+            )
+            self.mark_changed()
+        except PreconditionFailed:
+            # Someone else updated it first, their copy is as good as ours
+            logger.info(f"Queue manifest '{self.path}' changed while rebuilding.")
+
+    def update(self, mutate: Callable[[dict], None]) -> dict:
+        """Apply 'mutate' to the posts and write back, retrying on a race"""
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            content = self.read()
+            self.posts = content["posts"] if content else {}
+            mutate(self.posts)
+            try:
+                self.generation = self.gcs.upload_json(
+                    self.path,
+                    {"posts": self.posts},
+                    if_generation_match=self.generation,
+                )
+                self.mark_changed()
+                return self.posts
+            except PreconditionFailed:
+                logger.info(f"Queue manifest '{self.path}' changed, retrying update...")
+        raise RuntimeError(f"Could not update queue manifest '{self.path}'!")
+
+    def mark_changed(self):
+        self.marker_generation = self.gcs.upload_json(
+            self.marker_path, {"changed_at": time.time()}
+        )
+
+    def get_change_marker(self) -> int:
+        """Generation of the change marker, a metadata read only"""
+        return self.gcs.get_blob_generation(self.marker_path)
+
+    def add_post(self, id: int, images: list[str], config: str = None) -> dict:
+        def _add(posts: dict):
+            posts[str(id)] = {"images": sorted(images), "config": config}
+
+        return self.update(_add)
+
+    def remove_post(self, id: int) -> dict:
+        def _remove(posts: dict):
+            posts.pop(str(id), None)
+
+        return self.update(_remove)
+
+    def get_lowest_id(self) -> int:
+        return min((int(id) for id in self.posts), default=0)
+
+    def get_max_id(self) -> int:
+        return max((int(id) for id in self.posts), default=0)
+
+    def get_images(self, id: int) -> list[str]:
+        post = self.posts.get(str(id))
+        return list(post["images"]) if post else []
+
+    def get_config(self, id: int) -> str:
+        post = self.posts.get(str(id))
+        return post["config"] if post else None
@@ -0,0 +1,118 @@
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from google.api_core.exceptions import NotFound
+from src.cloud_storage import CloudStorageAdapter
+
+# Storage only accepts resumable chunks in multiples of this, bar the last one
+CHUNK_ALIGNMENT = 256 * 1024
+MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE", 32 * CHUNK_ALIGNMENT))
+STATE_FILE = "upload.json"
+# Storage expires resumable sessions after a week, uploads left longer are dropped
+STAGING_TTL = int(os.getenv("STAGING_TTL", 7 * 24 * 60 * 60))
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class ResumableUploads:
+    """
+    Chunked uploads streamed into storage resumable upload sessions, tus style:
+    the client creates an upload, sends chunks at the offset the server last
+    acknowledged, and after a dropped connection asks for the offset and
+    carries on from there. Only one chunk per upload is held in memory. The
+    state of each upload lives in the bucket next to it, as
+    '{staging_dir}/{upload_id}/upload.json':
+
+        {"file_name": "a.jpg", "size": 123, "offset": 0, "session_url": ...,
+         "created_at": ...}
+
+    Uploads abandoned for STAGING_TTL are deleted when next asked for, and the
+    bucket's lifecycle rule removes any that never are.
+    """
+
+    def __init__(self, gcs: CloudStorageAdapter, staging_dir: Path):
+        self.gcs = gcs
+        self.staging_dir = Path(staging_dir)
+
+    def get_state_path(self, upload_id: str) -> Path:
+        return self.staging_dir.joinpath(upload_id, STATE_FILE)
+
+    def get_blob_path(self, state: dict) -> Path:
+        return self.staging_dir.joinpath(state["upload_id"], state["file_name"])
+
+    def create(self, file_name: str, size: int, content_type: str) -> dict:
+        upload_id = uuid.uuid4().hex
+        state = {
+            "upload_id": upload_id,
+            "file_name": Path(file_name).name,
+            "size": size,
+            "offset": 0,
+            "content_type": content_type,
+            "created_at": time.time(),
+        }
+        state["session_url"] = self.gcs.create_resumable_session(
+            self.get_blob_path(state), content_type, size
+        )
+        self.save(state)
+        return state
+
+    def get(self, upload_id: str) -> dict:
+        state, _ = self.gcs.download_json_blob_with_generation(
+            self.get_state_path(upload_id)
+        )
+        if state is None:
+            raise FileNotFoundError(f"Upload '{upload_id}' not found!")
+        if time.time() - state.get("created_at", 0) > STAGING_TTL:
+            self.delete(state)
+            raise FileNotFoundError(f"Upload '{upload_id}' has expired!")
+        return state
+
+    def delete(self, state: dict):
+        for path in [self.get_blob_path(state), self.get_state_path(state["upload_id"])]:
+            try:
+                self.gcs.delete_blob(path)
+            except NotFound:
+                pass
+
+    def save(self, state: dict):
+        self.gcs.upload_json(self.get_state_path(state["upload_id"]), state)
+
+    def get_offset(self, upload_id: str) -> dict:
+        """Resync the offset with what storage has actually committed"""
+        state = self.get(upload_id)
+        if state["offset"] < state["size"]:
+            offset = self.gcs.get_resumable_offset(state["session_url"], state["size"])
+            if offset != state["offset"]:
+                state["offset"] = offset
+                self.save(state)
+        return state
+
+    def write_chunk(self, upload_id: str, offset: int, data: bytes) -> dict:
+        state = self.get(upload_id)
+        if offset != state["offset"]:
+            state = self.get_offset(upload_id)
+            if offset != state["offset"]:
+                raise ValueError(
+                    f"Chunk at offset {offset}, upload is at {state['offset']}!"
+                )
+        end = offset + len(data)
+        if end > state["size"]:
+            raise ValueError(f"Chunk ends at {end}, past the upload size {state['size']}!")
+        if len(data) % CHUNK_ALIGNMENT and end != state["size"]:
+            raise ValueError(f"Chunks must be multiples of {CHUNK_ALIGNMENT} bytes!")
+
+        state["offset"] = self.gcs.upload_chunk(
+            state["session_url"], data, offset, state["size"]
+        )
+        self.save(state)
+        return state
+
+    def complete(self, upload_id: str, destination_path: Path):
+        """Move a finished upload to its place in the bucket"""
+        state = self.get(upload_id)
+        if state["offset"] != state["size"]:
+            raise ValueError(f"Upload '{upload_id}' is not finished!")
+        self.gcs.move_blob(self.get_blob_path(state), destination_path)
+        self.gcs.delete_blob(self.get_state_path(upload_id))
@@ -1,4 +1,4 @@
-import React, {useEffect, useState} from 'react'
+import React, {useEffect, useRef, useState} from 'react'
 import 'bootstrap/dist/css/bootstrap.min.css';
 import '../css/App.css';
 import '../css/Button.css'
@@ -12,6 +12,10 @@ export default function PostDetails({ files, items }) {
     const [buttonDisabled, setButtonDisabled] = useState(false)
     const [posting, setPosting] = useState(false)
     const [buttonClass, setButtonClass] = useState('Button');
+    const uploadKey = useRef(null)
+    // {file name: {bytes_sent, total}} for the current upload
+    const fileProgress = useRef({})
+    const expectedTotal = useRef(0)
     const completeText = "Post Successful!"
 
     const checkPostInfo = async () => {
@@ -30,22 +34,33 @@ export default function PostDetails({ files, items }) {
       return () => clearInterval(interval);
     }, [caption, location, hashtags, items]);
 
-    const checkUploadStatus = async () => {
-        const response = await fetch("http://127.0.0.1:8000/api/uploadstatus/")
-        const status = await response.json()
-        if (status.data > maxUploadId && posting === true){
+    useEffect(() => {
+      // Progress and queue changes are pushed by the backend rather than polled
+      const events = new EventSource("http://127.0.0.1:8000/api/events/")
+      events.addEventListener("queue", (event) => {
+        const status = JSON.parse(event.data)
+        setMaxUploadId(status.data)
+        console.log("Max id is: " + status.data)
+      })
+      events.addEventListener("file", (event) => {
+        const progress = JSON.parse(event.data)
+        if (progress.upload_key === uploadKey.current && progress.total > 0){
+            fileProgress.current[progress.file] = progress
+            // Files that have not reported yet still count towards the total
+            const sent = Object.values(fileProgress.current).reduce((sum, file) => sum + file.bytes_sent, 0)
+            const reported = Object.values(fileProgress.current).reduce((sum, file) => sum + file.total, 0)
+            const total = Math.max(reported, expectedTotal.current)
+            setUploadStatus("Posting... " + Math.round(100 * sent / total) + "%")
+        }
+      })
+      events.addEventListener("post", (event) => {
+        const post = JSON.parse(event.data)
+        if (post.upload_key === uploadKey.current && post.state === "complete"){
             setUploadStatus(completeText)
         }
-        setMaxUploadId(status.data)
-        console.log("Max id is: " + status.data + "\tPosting: " + posting + "\tUpload status: " + uploadStatus)
-      }
-
-    useEffect(() => {
-      const interval = setInterval(() => {
-        checkUploadStatus()
-      }, 2000);
-      return () => clearInterval(interval);
-    }, [posting, uploadStatus]);
+      })
+      return () => events.close();
+    }, []);
 
     useEffect(() => {
         if (uploadStatus === completeText){
@@ -57,6 +72,9 @@ export default function PostDetails({ files, items }) {
 
     const handleUploadPost = async () => {
         event.preventDefault()
+        uploadKey.current = Date.now() + "-" + Math.random().toString(36).slice(2)
+        fileProgress.current = {}
+        expectedTotal.current = files.reduce((sum, file) => sum + file.file.size, 0)
         setPosting(true)
         setUploadStatus("Posting...")
         setButtonDisabled(true)
@@ -86,6 +104,11 @@ export default function PostDetails({ files, items }) {
             fileFormData.append('image_order', item.name)
         })
 
+        fileFormData.append(
+            "upload_key",
+            uploadKey.current
+        )
+
         await fetch("http://127.0.0.1:8000/api/uploadimages/", {
             method: "POST",
             body: fileFormData
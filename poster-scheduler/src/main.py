@@ -1,20 +1,40 @@
 from google.api_core.exceptions import NotFound
-from src.utils.image_utils import PostManager, ImageChecker
+from instagrapi.exceptions import LoginRequired
+from src.utils.image_utils import (
+    PostManager,
+    ImageChecker,
+    get_size_from_header,
+    refine_image,
+    PROBE_BYTES,
+    MAX_PROBE_BYTES,
+)
 from src.utils.instagram import InstagramAdapter
 from src.utils.cloud_storage import CloudStorageAdapter
+from src.utils.image_cache import DerivedImageCache
 import os
 import logging
 from src.utils.log import setup_custom_logger
 from src.utils.types import ImageDirectories
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+import tempfile
 
 PROJECT = os.getenv("GOOGLE_PROJECT_ID")
 BUCKET = f"{PROJECT}-images"
 ACCOUNT = os.getenv("ACCOUNT", "test")
 UPLOAD_TYPE = os.getenv("UPLOAD_TYPE", "post")
 HIGHLIGHT = os.getenv("HIGHLIGHT", "new") if UPLOAD_TYPE == "story" else None
+MAX_PROCESS_WORKERS = int(os.getenv("MAX_PROCESS_WORKERS", os.cpu_count() or 1))
+# Originals downloaded at once, and so held in memory, while refining cache misses
+DOWNLOAD_WINDOW = int(os.getenv("DOWNLOAD_WINDOW", 4))
 DOWN_SAMPLED_DIR = Path(f"{ACCOUNT}/down_sampled")
 PROCESSED_DIR = Path(f"{ACCOUNT}/processed")
+CACHE_DIR = Path(f"{ACCOUNT}/cache")
+LOCAL_CACHE_DIR = os.getenv("LOCAL_CACHE_DIR")
+# /tmp is in memory on Cloud Run, so processed images never touch a disk
+LOCAL_PROCESSED_DIR = Path(
+    os.getenv("LOCAL_PROCESSED_DIR", tempfile.gettempdir())
+).joinpath(PROCESSED_DIR)
 UNPROCESSED_DIR = (
     Path(f"{ACCOUNT}/stories")
     if UPLOAD_TYPE == "story"
@@ -24,6 +44,7 @@ dirs = ImageDirectories(
     unprocessed=UNPROCESSED_DIR,
     down_sampled=DOWN_SAMPLED_DIR,
     processed=PROCESSED_DIR,
+    cache=CACHE_DIR,
 )
 
 setup_custom_logger("insta_poster_logger")
@@ -42,10 +63,16 @@ class InstaPosterApp:
         self.gcs = None
         self.pm = None
         self.images_to_post = None
+        self.cache = None
+        self.cache_keys = []
+        self.local_processed_dir = LOCAL_PROCESSED_DIR
+        self.archive_executor = None
+        self.archive = None
 
     def post(self):
         logger.info(f"Starting {self.upload_type} upload...")
         self.gcs = CloudStorageAdapter(self.bucket)
+        self.cache = DerivedImageCache(self.gcs, self.dirs.cache, LOCAL_CACHE_DIR)
         self.pm = PostManager(self.bucket)
         self.images_to_post = self.pm.get_images_to_post(
             subdirectory=self.dirs.unprocessed
@@ -59,7 +86,14 @@ class InstaPosterApp:
 
         caption, location, hashtags = self.refine_images()
 
-        self.post_images(caption, location, hashtags)
+        try:
+            self.post_images(caption, location, hashtags)
+        except LoginRequired:
+            # Revoked since it was last validated, the retried run logs in again
+            logger.warning("Instagram session was revoked, invalidating it.")
+            self.insta.invalidate_session()
+            raise
+        self.wait_for_archive()
 
         if ACCOUNT == "prod":
             self.delete_posted_images(str(self.pm.lowest_id))
@@ -76,15 +110,21 @@ class InstaPosterApp:
         """
         logger.info("Refining images...")
         aspect_ratios = []
-        imgs_buffer = []
         ic = ImageChecker(self.upload_type)
 
-        for img_name in self.images_to_post:
-            unprocessed_path = self.dirs.unprocessed.joinpath(img_name)
-            img_bytes = self.gcs.download_blob_to_bytes(unprocessed_path)
-            ic.set_image(img_bytes)
-            aspect_ratios.append(ic.get_aspect_ratio())
-            imgs_buffer.append(img_bytes)
+        unprocessed_paths = [
+            self.dirs.unprocessed.joinpath(img_name) for img_name in self.images_to_post
+        ]
+        sizes = self.gcs.map_concurrently(self.probe_image_size, unprocessed_paths)
+        for img_name, unprocessed_path, size in zip(
+            self.images_to_post, unprocessed_paths, sizes
+        ):
+            if size is None:
+                logger.info(f"Could not probe '{img_name}', downloading in full...")
+                ic.set_image(self.gcs.download_blob_to_bytes(unprocessed_path))
+                size = ic.image.size
+            width, height = size
+            aspect_ratios.append(width / height)
 
         # All ARs in album are needed before adding the borders
         target_ar = ic.get_border_aspect_ratio(aspect_ratios)
@@ -101,44 +141,153 @@ class InstaPosterApp:
             location = None
             hashtags = self.insta.get_hash_tags([])
 
-        for idx, (img_bytes, img_name) in enumerate(
-            zip(imgs_buffer, self.images_to_post)
-        ):
-            ic.set_image(img_bytes)
-            if ic.image_too_large():
-                ic.down_sample_image()
-            down_sampled_image_path = self.dirs.down_sampled.joinpath(img_name)
-            self.gcs.upload_image_from_bytes(
-                image=ic.image, destination_path=down_sampled_image_path
-            )
+        num_images = len(self.images_to_post)
+        # Captions only go on the first image of a story
+        add_captions = self.upload_type == "story" and location and caption
+        locations = [location.name if add_captions else None] + [None] * (num_images - 1)
+        captions = [caption if add_captions else None] + [None] * (num_images - 1)
 
-            ic.add_border(target_ar)
-            if idx == 0 and self.upload_type == "story" and location and caption:
-                ic.add_captions(location=location.name, caption=caption)
-            processed_image_path = self.dirs.processed.joinpath(img_name)
-            self.gcs.upload_image_from_bytes(
-                image=ic.image, destination_path=processed_image_path
+        refined = [None] * num_images
+        if self.cache:
+            fingerprints = self.gcs.map_concurrently(
+                self.gcs.get_blob_fingerprint, unprocessed_paths
             )
+            self.cache_keys = [
+                self.cache.get_key(*params)
+                for params in zip(
+                    fingerprints,
+                    [self.upload_type] * num_images,
+                    [target_ar] * num_images,
+                    locations,
+                    captions,
+                )
+            ]
+            refined = self.gcs.map_concurrently(self.cache.get, self.cache_keys)
+        misses = [idx for idx, images in enumerate(refined) if images is None]
+        logger.info(f"{num_images - len(misses)} of {num_images} images already refined")
+
+        refined_misses = self.refine_misses(
+            [unprocessed_paths[idx] for idx in misses],
+            target_ar,
+            [locations[idx] for idx in misses],
+            [captions[idx] for idx in misses],
+        )
+
+        cache_puts = []
+        for idx, images in zip(misses, refined_misses):
+            refined[idx] = images
+            if self.cache:
+                cache_puts.append((self.cache_keys[idx], *images))
+
+        # Post from local copies, the bucket copies are only kept as an archive
+        self.local_processed_dir.mkdir(parents=True, exist_ok=True)
+        for img_name, (_, processed) in zip(self.images_to_post, refined):
+            self.local_processed_dir.joinpath(img_name).write_bytes(processed)
+        # Cache hits were archived by the run that refined them
+        uploads = []
+        for idx in misses:
+            img_name = self.images_to_post[idx]
+            down_sampled, processed = refined[idx]
+            uploads.append((self.dirs.down_sampled.joinpath(img_name), down_sampled))
+            uploads.append((self.dirs.processed.joinpath(img_name), processed))
+        self.archive_refined_images(uploads, cache_puts)
 
         return caption, location, hashtags
 
+    def refine_misses(
+        self,
+        blob_paths: list[Path],
+        target_ar: float,
+        locations: list[str],
+        captions: list[str],
+    ) -> list[tuple[bytes]]:
+        """
+        Download originals a window at a time, in parallel, and refine each
+        window across the worker processes, so at most DOWNLOAD_WINDOW
+        originals are held in memory however big the album
+        """
+        max_workers = min(MAX_PROCESS_WORKERS, len(blob_paths))
+        window = max(DOWNLOAD_WINDOW, max_workers)
+        executor = ProcessPoolExecutor(max_workers) if max_workers > 1 else None
+        refine_all = executor.map if executor else map
+        refined = []
+        try:
+            for start in range(0, len(blob_paths), window):
+                end = start + window
+                originals = self.gcs.map_concurrently(
+                    self.gcs.download_blob_as_bytes, blob_paths[start:end], window
+                )
+                refined += refine_all(
+                    refine_image,
+                    originals,
+                    [self.upload_type] * len(originals),
+                    [target_ar] * len(originals),
+                    locations[start:end],
+                    captions[start:end],
+                )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return refined
+
+    def archive_refined_images(self, uploads: list[tuple], cache_puts: list[tuple]):
+        """Upload refined images to the bucket in the background while posting"""
+
+        def _archive():
+            self.gcs.upload_many(uploads)
+            for cache_put in cache_puts:
+                self.cache.put(*cache_put)
+
+        self.archive_executor = ThreadPoolExecutor(max_workers=1)
+        self.archive = self.archive_executor.submit(_archive)
+
+    def wait_for_archive(self):
+        """Wait for the archive uploads, a failure there should not fail the post"""
+        if self.archive is None:
+            return
+        try:
+            self.archive.result()
+            logger.info("Refined images archived.")
+        except Exception as e:
+            logger.error(f"Could not archive refined images: {e}")
+        finally:
+            self.archive_executor.shutdown()
+            self.archive = None
+
+    def probe_image_size(self, blob_path: Path) -> tuple[int] | None:
+        """Get an image's size from ranged reads of its header only"""
+        probe_bytes = PROBE_BYTES
+        while probe_bytes <= MAX_PROBE_BYTES:
+            header = self.gcs.download_blob_range(blob_path, 0, probe_bytes - 1)
+            size = get_size_from_header(header)
+            if size or len(header) < probe_bytes:
+                return size
+            # Large EXIF blocks (e.g. embedded previews) can push the frame header out
+            probe_bytes *= 4
+        return None
+
     def post_images(self, caption: str, location: str, hashtags: str):
         logger.info("Posting images...")
-        self.copy_processed_images()
+        processed_dir = self.local_processed_dir
+        if not all(
+            processed_dir.joinpath(image).is_file() for image in self.images_to_post
+        ):
+            self.copy_processed_images()
+            processed_dir = self.dirs.processed
 
         if self.upload_type == "post":
             if len(self.images_to_post) > 1:
                 self.insta.upload_album(
-                    dirs.processed, self.images_to_post, caption, location
+                    processed_dir, self.images_to_post, caption, location
                 )
             else:
                 self.insta.upload_picture(
-                    dirs.processed, self.images_to_post[0], caption, location
+                    processed_dir, self.images_to_post[0], caption, location
                 )
             self.insta.add_comment(hashtags)
         elif self.upload_type == "story":
             self.insta.upload_pictures_to_story(
-                dirs.processed,
+                processed_dir,
                 self.images_to_post,
                 caption,
                 location,
@@ -147,12 +296,22 @@ class InstaPosterApp:
             )
 
     def copy_processed_images(self):
-        for image in self.images_to_post:
-            self.gcs.download_blob_to_file(image, self.dirs.processed)
+        self.gcs.download_many_to_files(self.images_to_post, self.dirs.processed)
 
     def delete_posted_images(self, id: str):
         logger.info("Deleting images...")
-        self.gcs.delete_all_blobs(prefix=str(dirs.unprocessed.joinpath(id)))
+        # Exactly the post's blobs, a prefix of '1' would also match posts 10-19
+        manifest = self.pm.manifest
+        posted = manifest.get_images(id) + [manifest.get_config(id)]
+        try:
+            self.gcs.delete_many(
+                [self.dirs.unprocessed.joinpath(name) for name in posted if name]
+            )
+        except NotFound:
+            logger.warning(f"Some images of post {id} were already deleted.")
+        self.pm.remove_posted(int(id))
+        if self.cache and self.cache_keys:
+            self.cache.delete(self.cache_keys)
 
 
 if __name__ == "__main__":
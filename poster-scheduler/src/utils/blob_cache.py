@@ -0,0 +1,75 @@
+import logging
+import time
+from pathlib import Path
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from src.utils.cloud_storage import CloudStorageAdapter
+
+MAX_WRITE_ATTEMPTS = 3
+
+logger = logging.getLogger("insta_poster_logger")
+
+# In-process layer, shared by every cache on the same blob
+_memory = {}
+
+
+class JsonBlobCache:
+    """
+    Small key/value cache persisted as a single json blob in the bucket, with
+    an in-process layer on top. Entries older than 'ttl' seconds are treated as
+    misses. Writes merge into the latest copy of the blob using generation
+    preconditions, so concurrent jobs do not drop each other's entries.
+    """
+
+    def __init__(self, gcs: CloudStorageAdapter, path: Path, ttl: float):
+        self.gcs = gcs
+        self.path = Path(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def normalise_key(key: str) -> str:
+        return " ".join(str(key).lower().split())
+
+    @property
+    def entries(self) -> dict:
+        if str(self.path) not in _memory:
+            _memory[str(self.path)] = self.read()[0]
+        return _memory[str(self.path)]
+
+    def read(self) -> tuple[dict, int]:
+        try:
+            content, generation = self.gcs.download_json_blob_with_generation(
+                self.path
+            )
+        except NotFound:
+            # Replaced between fetching its metadata and its contents
+            content, generation = None, None
+        return content or {}, generation
+
+    def get(self, key: str) -> dict | None:
+        entry = self.entries.get(self.normalise_key(key))
+        if entry is None or time.time() - entry["cached_at"] > self.ttl:
+            return None
+        return entry["value"]
+
+    def put(self, key: str, value: dict):
+        self.put_many({key: value})
+
+    def put_many(self, values: dict):
+        """Add entries, best effort as the cache can always be refilled"""
+        new_entries = {
+            self.normalise_key(key): {"value": value, "cached_at": time.time()}
+            for key, value in values.items()
+        }
+        self.entries.update(new_entries)
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            content, generation = self.read()
+            if generation is None:
+                continue
+            content.update(new_entries)
+            try:
+                self.gcs.upload_json(self.path, content, if_generation_match=generation)
+                _memory[str(self.path)] = content
+                return
+            except PreconditionFailed:
+                logger.info(f"Cache '{self.path}' changed, retrying write...")
+        logger.warning(f"Could not write to cache '{self.path}'.")
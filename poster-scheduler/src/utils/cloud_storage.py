@@ -1,20 +1,46 @@
+import functools
 import io
 import os
 from pathlib import Path
 
 import yaml
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 import logging
 import json
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from src.utils.misc import get_default_credentials
 
 logger = logging.getLogger("insta_poster_logger")
 
+MAX_TRANSFER_WORKERS = 8
+# Connections kept open to the storage API, shared by every adapter in the process
+HTTP_POOL_SIZE = int(os.getenv("STORAGE_HTTP_POOL_SIZE", 32))
+
+
+@functools.cache
+def get_storage_client() -> storage.Client:
+    """
+    The storage client for this process, so credentials are refreshed and
+    connections set up once rather than for every adapter
+    """
+    credentials, project = get_default_credentials()
+    credentials = with_scopes_if_required(credentials, storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
 
 class CloudStorageAdapter:
-    def __init__(self, bucket_name: str) -> None:
-        self.storage_client = storage.Client()
+    def __init__(self, bucket_name: str, storage_client: storage.Client = None) -> None:
+        self.storage_client = storage_client or get_storage_client()
         self.bucket_name = bucket_name
         self.bucket = self.storage_client.bucket(bucket_name)
 
@@ -66,13 +92,46 @@ class CloudStorageAdapter:
     def delete_all_blobs(self, prefix: str = None):
         blobs = self.list_blobs(prefix)
         if blobs:
-            for blob in blobs:
-                self.delete_blob(blob)
-                msg = f"Blob '{blob}' in {self.bucket_name} bucket deleted."
-                logger.info(msg), print(msg)
+            self.delete_many(blobs)
+            msg = f"{len(blobs)} blobs in {self.bucket_name} bucket deleted."
+            logger.info(msg), print(msg)
         else:
             logger.info(f"{self.bucket_name} bucket already empty.")
 
+    @staticmethod
+    def map_concurrently(
+        func: Callable, items: Iterable, max_workers: int = MAX_TRANSFER_WORKERS
+    ) -> list:
+        """Run 'func' over 'items' on a bounded thread pool, keeping their order"""
+        items = list(items)
+        if len(items) <= 1 or max_workers <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def download_many_to_files(
+        self, blob_names: list[str], path: str, max_workers: int = MAX_TRANSFER_WORKERS
+    ):
+        """Download 'path/blob_name' blobs to the same local paths"""
+        self.map_concurrently(
+            lambda blob_name: self.download_blob_to_file(blob_name, path),
+            blob_names,
+            max_workers,
+        )
+
+    def upload_many(
+        self,
+        uploads: list[tuple[Path, bytes]],
+        max_workers: int = MAX_TRANSFER_WORKERS,
+    ):
+        """Upload (destination_path, data) pairs, content type taken from the suffix"""
+        self.map_concurrently(
+            lambda upload: self.upload_bytes(*upload), uploads, max_workers
+        )
+
+    def delete_many(self, blob_names: list[Path], max_workers: int = MAX_TRANSFER_WORKERS):
+        self.map_concurrently(self.delete_blob, blob_names, max_workers)
+
     def upload_file_to_gcs(self, file_path: Path, subdirectory: Path = None):
         if not Path.is_file(file_path):
             logger.error(f"File '{file_path}' does not exist locally!")
@@ -117,8 +176,7 @@ class CloudStorageAdapter:
 
     def download_blob_to_file(self, blob_name: str, path: str):
         blob = self.bucket.blob(f"{path}/{blob_name}")
-        if not os.path.exists(path):
-            os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
         blob.download_to_filename(f"{path}/{blob_name}")
 
     def download_blob_to_bytes(self, file_name: Path):
@@ -126,12 +184,39 @@ class CloudStorageAdapter:
         blob = self.bucket.get_blob(str(file_name)).download_as_string()
         return io.BytesIO(blob)
 
-    def upload_image_from_bytes(self, image: Image, destination_path: Path):
-        img_ext = destination_path.name.split(".")[1]
+    def download_blob_as_bytes(self, file_name: Path) -> bytes:
+        return self.bucket.blob(str(file_name)).download_as_bytes()
+
+    def download_blob_if_exists(self, file_name: Path) -> bytes | None:
+        blob = self.bucket.blob(str(file_name))
+        try:
+            return blob.download_as_bytes()
+        except NotFound:
+            return None
+
+    def get_blob_fingerprint(self, file_name: Path) -> str:
+        """Content hash of a blob, its generation if it has no hash"""
+        blob = self.bucket.get_blob(str(file_name))
+        return blob.md5_hash or blob.crc32c or str(blob.generation)
+
+    def download_blob_range(self, file_name: Path, start: int, end: int) -> bytes:
+        """Download the inclusive byte range [start, end] of a blob"""
+        blob = self.bucket.blob(str(file_name))
+        return blob.download_as_bytes(start=start, end=end)
+
+    @staticmethod
+    def image_to_bytes(image: Image) -> bytes:
         buffer = io.BytesIO()
         image.save(buffer, format="JPEG")
+        return buffer.getvalue()
+
+    def upload_image_from_bytes(self, image: Image, destination_path: Path):
+        self.upload_bytes(destination_path, self.image_to_bytes(image))
+
+    def upload_bytes(self, destination_path: Path, data: bytes):
+        img_ext = destination_path.name.split(".")[1]
         blob = self.bucket.blob(str(destination_path))
-        blob.upload_from_string(buffer.getvalue(), content_type=f"image/{img_ext}")
+        blob.upload_from_string(data, content_type=f"image/{img_ext}")
 
     def upload_from_string(self, file_path: Path, content: str):
         blob = self.bucket.blob(str(file_path))
@@ -140,10 +225,18 @@ class CloudStorageAdapter:
             content = json.dumps(content)
         blob.upload_from_string(data=content, content_type=f"application/{ext}")
 
-    def upload_json(self, file_path: Path, content: dict):
+    def upload_json(
+        self, file_path: Path, content: dict, if_generation_match: int = None
+    ) -> int:
+        """Upload a json blob, optionally only if its generation still matches"""
         blob = self.bucket.blob(str(file_path))
         dumped = json.dumps(content, indent=4)
-        blob.upload_from_string(data=dumped, content_type="application/json")
+        blob.upload_from_string(
+            data=dumped,
+            content_type="application/json",
+            if_generation_match=if_generation_match,
+        )
+        return blob.generation
 
     def download_json_blob(self, blob_path: Path) -> dict:
         blob = self.bucket.blob(str(blob_path))
@@ -152,6 +245,19 @@ class CloudStorageAdapter:
             blob_str = json.loads(blob_str)
         return blob_str
 
+    def get_blob_generation(self, blob_path: Path) -> int:
+        """Generation of a blob from its metadata, 0 if it does not exist"""
+        blob = self.bucket.get_blob(str(blob_path))
+        return blob.generation if blob else 0
+
+    def download_json_blob_with_generation(self, blob_path: Path) -> tuple[dict, int]:
+        """Download a json blob with its generation, generation is 0 if missing"""
+        blob = self.bucket.get_blob(str(blob_path))
+        if blob is None:
+            return None, 0
+        blob_str = blob.download_as_bytes()
+        return json.loads(blob_str), blob.generation
+
     def download_yaml_blob(self, blob_path: Path) -> dict:
         blob = self.bucket.blob(str(blob_path))
         blob_str = blob.download_as_string()
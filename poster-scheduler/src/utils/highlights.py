@@ -0,0 +1,89 @@
+import logging
+from datetime import datetime
+from pathlib import Path
+from google.api_core.exceptions import PreconditionFailed
+from src.utils.cloud_storage import CloudStorageAdapter
+
+DATE_FMT = "%y-%m-%d %H:%M:%S"
+MAX_WRITE_ATTEMPTS = 5
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class HighlightRegistry:
+    """
+    Registry of the highlights we have created, stored as
+
+        {"latest": "123", "highlights": {"123": {"story_id": ..., "caption": ...,
+                                                 "created_at": ...}}}
+
+    The latest pointer is kept up to date on write, so looking up the latest
+    highlight or checking a pk is a dict lookup. Writes are conditional on the
+    generation that was read, so concurrent story jobs cannot lose each other's
+    highlights. The old flat {pk: {...}} format is read and upgraded on write.
+    """
+
+    def __init__(self, gcs: CloudStorageAdapter, path: Path):
+        self.gcs = gcs
+        self.path = Path(path)
+        self.registry = None
+        self.generation = None
+
+    @staticmethod
+    def from_flat(highlight_pks: dict) -> dict:
+        latest = None
+        if highlight_pks:
+            latest = max(
+                highlight_pks,
+                key=lambda pk: datetime.strptime(
+                    highlight_pks[pk]["created_at"], DATE_FMT
+                ),
+            )
+        return {"latest": latest, "highlights": highlight_pks}
+
+    def read(self) -> dict:
+        content, self.generation = self.gcs.download_json_blob_with_generation(
+            self.path
+        )
+        if content is None:
+            self.registry = None
+        elif "highlights" not in content:
+            self.registry = self.from_flat(content)
+        else:
+            self.registry = content
+        return self.registry
+
+    def load(self) -> dict:
+        """Read the registry once per run"""
+        if self.generation is None:
+            self.read()
+        return self.registry
+
+    def exists(self) -> bool:
+        return self.load() is not None
+
+    def __contains__(self, highlight_pk: str) -> bool:
+        return self.exists() and str(highlight_pk) in self.registry["highlights"]
+
+    def get_latest_pk(self) -> str:
+        return self.load()["latest"] if self.exists() else None
+
+    def add(self, highlight_pk: str, story_id: str, caption: str):
+        entry = {
+            "story_id": story_id,
+            "caption": caption,
+            "created_at": datetime.now().strftime(DATE_FMT),
+        }
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            registry = self.read() or {"latest": None, "highlights": {}}
+            registry["highlights"][str(highlight_pk)] = entry
+            registry["latest"] = str(highlight_pk)
+            try:
+                self.generation = self.gcs.upload_json(
+                    self.path, registry, if_generation_match=self.generation
+                )
+                self.registry = registry
+                return
+            except PreconditionFailed:
+                logger.info(f"Highlight registry '{self.path}' changed, retrying...")
+        raise RuntimeError(f"Could not save highlight {highlight_pk}!")
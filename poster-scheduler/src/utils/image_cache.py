@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from google.api_core.exceptions import NotFound
+from src.utils.cloud_storage import CloudStorageAdapter
+
+# Bump when refine_image changes its output so old entries are not reused
+CACHE_VERSION = 1
+CACHE_KINDS = ["down_sampled", "processed"]
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class DerivedImageCache:
+    """
+    Cache of refined images keyed by the source blob's content hash and the
+    processing parameters, so a retried or re-run job can skip downloading and
+    processing originals it has already refined. Entries live in the bucket as
+    '{cache_dir}/{key}/{kind}.jpg', with an optional local directory in front.
+    """
+
+    def __init__(
+        self, gcs: CloudStorageAdapter, cache_dir: Path, local_dir: Path = None
+    ):
+        self.gcs = gcs
+        self.cache_dir = Path(cache_dir)
+        self.local_dir = Path(local_dir) if local_dir else None
+
+    @staticmethod
+    def get_key(
+        fingerprint: str,
+        upload_type: str,
+        target_ar: float,
+        location: str = None,
+        caption: str = None,
+    ) -> str:
+        params = [CACHE_VERSION, fingerprint, upload_type, target_ar, location, caption]
+        return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()[:32]
+
+    def get(self, key: str) -> tuple[bytes] | None:
+        """Get the (down_sampled, processed) images for a key, None on a miss"""
+        cached = [self.get_local(key, kind) for kind in CACHE_KINDS]
+        if all(cached):
+            return tuple(cached)
+
+        cached = [
+            self.gcs.download_blob_if_exists(self.cache_dir.joinpath(key, f"{kind}.jpg"))
+            for kind in CACHE_KINDS
+        ]
+        if not all(cached):
+            return None
+        for kind, data in zip(CACHE_KINDS, cached):
+            self.put_local(key, kind, data)
+        return tuple(cached)
+
+    def put(self, key: str, down_sampled: bytes, processed: bytes):
+        uploads = []
+        for kind, data in zip(CACHE_KINDS, [down_sampled, processed]):
+            self.put_local(key, kind, data)
+            uploads.append((self.cache_dir.joinpath(key, f"{kind}.jpg"), data))
+        self.gcs.upload_many(uploads)
+
+    def delete(self, keys: list[str]):
+        blobs = []
+        for key in keys:
+            for kind in CACHE_KINDS:
+                blobs.append(self.cache_dir.joinpath(key, f"{kind}.jpg"))
+                if self.local_dir:
+                    self.local_dir.joinpath(key, f"{kind}.jpg").unlink(missing_ok=True)
+        try:
+            self.gcs.delete_many(blobs)
+        except NotFound:
+            logger.warning("Some cached images were already deleted.")
+
+    def get_local(self, key: str, kind: str) -> bytes | None:
+        if not self.local_dir:
+            return None
+        path = self.local_dir.joinpath(key, f"{kind}.jpg")
+        return path.read_bytes() if path.is_file() else None
+
+    def put_local(self, key: str, kind: str, data: bytes):
+        if not self.local_dir:
+            return
+        path = self.local_dir.joinpath(key, f"{kind}.jpg")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
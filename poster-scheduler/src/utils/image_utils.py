@@ -7,6 +7,7 @@ import logging
 from PIL import ImageFont
 from pilmoji import Pilmoji
 from src.utils.cloud_storage import CloudStorageAdapter
+from src.utils.manifest import QueueManifest
 
 MAX_PIXEL_WIDTH = 1080
 MAX_PIXEL_HEIGHT = 1350
@@ -17,15 +18,31 @@ STORY_ASPECT_RATIO = 0.5625
 EXTRA_BORDER = 0
 BORDER_COLOR = "black"
 VALID_IMAGE_EXTS = [".jpg", ".png"]
+PROBE_BYTES = 64 * 1024
+MAX_PROBE_BYTES = 1024 * 1024
 
 logger = logging.getLogger("insta_poster_logger")
 
 
+def get_size_from_header(header: bytes) -> tuple[int] | None:
+    """
+    Read (width, height) from the start of a JPEG/PNG file. Pillow only parses
+    the header on open, so this needs everything up to the JPEG start of frame
+    or the PNG IHDR chunk, and returns None if the header is cut short.
+    """
+    try:
+        with Image.open(BytesIO(header)) as image:
+            return image.size
+    except OSError:
+        return None
+
+
 class ImageChecker:
     def __init__(self, upload_type):
         self.border_height = None
         self.downsampled_width = None
         self.downsampled_height = None
+        self.down_sampled_image = None
         self.aspect_ratio = None
         self.height = None
         self.width = None
@@ -57,7 +74,8 @@ class ImageChecker:
     def crop_image(self, coords: tuple[int]):
         self.image = self.image.crop(coords)
 
-    def down_sample_image(self):
+    def get_down_sampled_size(self) -> tuple[int]:
+        """Largest size within the limits keeping the original's aspect ratio"""
         height = self.height
         width = self.width
 
@@ -69,12 +87,26 @@ class ImageChecker:
             height = int((height / width) * MAX_PIXEL_WIDTH)
             width = MAX_PIXEL_WIDTH
 
+        return width, height
+
+    def down_sample_image(self):
+        width, height = self.get_down_sampled_size()
+        self.draft_image((width, height))
         self.image = self.image.resize((width, height))
 
-    def add_border(self, target_ar: int) -> list[int]:
-        y = self.height
-        x = self.width
-        ar = self.get_aspect_ratio()
+    def draft_image(self, size: tuple[int]):
+        """
+        Let the JPEG decoder scale the image down by 1/2, 1/4 or 1/8 in the DCT
+        domain, to the smallest scale still at least 'size'. Only has an effect
+        before the image is loaded and on JPEGs. Keeps width and height as the
+        original's so the geometry is unchanged.
+        """
+        if self.image.draft(self.image.mode, size):
+            logger.debug(f"Decoding image at {self.image.size} instead of full size")
+
+    def get_border_geometry(self, x: int, y: int, target_ar: float) -> list[int]:
+        """Get [width, height, x border, y border] to fit an x by y image in target_ar"""
+        ar = x / y
         x_prime = MAX_PIXEL_WIDTH
         y_prime = int(MAX_PIXEL_WIDTH / target_ar)
         # If we need to crop and add border
@@ -101,8 +133,17 @@ class ImageChecker:
             y_hat = int(y_prime)
             y_bar = 0
 
-        self.downsampled_width = int(x_hat)
-        self.downsampled_height = int(y_hat)
+        return [int(x_hat), int(y_hat), int(x_bar), int(y_bar)]
+
+    def add_border(self, target_ar: int) -> list[int]:
+        y = self.height
+        x = self.width
+        self.get_aspect_ratio()
+        geometry = self.get_border_geometry(x, y, target_ar)
+        x_hat, y_hat, x_bar, y_bar = geometry
+
+        self.downsampled_width = x_hat
+        self.downsampled_height = y_hat
         self.border_height = y_bar
         self.image = self.image.resize(
             (self.downsampled_width, self.downsampled_height)
@@ -110,7 +151,38 @@ class ImageChecker:
         border = (x_bar, y_bar, x_bar, y_bar)
         self.image = ImageOps.expand(self.image, border=border, fill=BORDER_COLOR)
 
-        return [int(x_hat), int(y_hat), int(x_bar), int(y_bar)]
+        return geometry
+
+    def fit_to_border(self, target_ar: float) -> list[int]:
+        """
+        Border in one step: resample the image once, straight to its final
+        size, and paste it onto a canvas of the bordered size. Skips the
+        resample if the image is already that size. The image before the border
+        is kept as 'down_sampled_image'.
+        """
+        geometry = self.get_border_geometry(self.width, self.height, target_ar)
+        x_hat, y_hat, x_bar, y_bar = geometry
+
+        self.downsampled_width = x_hat
+        self.downsampled_height = y_hat
+        self.border_height = y_bar
+        if self.image_too_large():
+            self.draft_image((x_hat, y_hat))
+        if self.image.size == (x_hat, y_hat):
+            self.down_sampled_image = self.image
+        else:
+            self.down_sampled_image = self.image.resize(
+                (x_hat, y_hat), resample=Image.Resampling.LANCZOS
+            )
+        canvas = Image.new(
+            self.down_sampled_image.mode,
+            (x_hat + 2 * x_bar, y_hat + 2 * y_bar),
+            BORDER_COLOR,
+        )
+        canvas.paste(self.down_sampled_image, (x_bar, y_bar))
+        self.image = canvas
+
+        return geometry
 
     def get_border_aspect_ratio(self, image_ars: list[float]) -> float:
         """Get the border's aspect ratio"""
@@ -164,12 +236,48 @@ class ImageChecker:
         return os.path.join(path, f"{_id}.yaml")
 
 
+def refine_image(
+    img_bytes: bytes,
+    upload_type: str,
+    target_ar: float,
+    location: str = None,
+    caption: str = None,
+) -> tuple[bytes]:
+    """
+    Down sample and border a single image, returning the JPEG encoded down
+    sampled and processed images. Only takes and returns plain values so it
+    can run in a worker process.
+    """
+    ic = ImageChecker(upload_type)
+    ic.set_image(BytesIO(img_bytes))
+    x_hat, y_hat, _, _ = ic.get_border_geometry(ic.width, ic.height, target_ar)
+    # The archived copy keeps the original's aspect ratio, only the processed
+    # image is fitted to the border. Both are resampled once from one decode,
+    # drafted to the smallest scale still big enough for either.
+    archive_size = ic.get_down_sampled_size()
+    ic.draft_image((max(archive_size[0], x_hat), max(archive_size[1], y_hat)))
+    archive = ic.image
+    if archive.size != archive_size:
+        archive = archive.resize(archive_size, resample=Image.Resampling.LANCZOS)
+    down_sampled = CloudStorageAdapter.image_to_bytes(archive)
+    if archive.size == (x_hat, y_hat):
+        ic.image = archive
+    ic.fit_to_border(target_ar)
+
+    if location and caption:
+        ic.add_captions(location=location, caption=caption)
+    processed = CloudStorageAdapter.image_to_bytes(ic.image)
+
+    return down_sampled, processed
+
+
 class PostManager:
     def __init__(self, bucket):
         self.bucket = bucket
         self.cs = CloudStorageAdapter(bucket)
         self.num_id_pattern = re.compile(r"^[0-9]+")
         self.lowest_id = None
+        self.manifest = None
 
     def get_lowest_id(self, files: list[str]) -> int:
         ids = []
@@ -197,21 +305,23 @@ class PostManager:
         return selected_images
 
     def get_images_to_post(self, subdirectory=None) -> list[str]:
-        """Select the most recent photo/s from the bucket"""
-        file_paths = self.cs.list_blobs(prefix=subdirectory)
-        file_names = []
+        """Select the most recent photo/s from the queue manifest"""
         images_to_post = []
-        for file in file_paths:
-            file_name = Path(file).name
-            if file_name:
-                file_names.append(file_name)
-
-        self.lowest_id = self.get_lowest_id(file_names)
+        self.manifest = QueueManifest(self.cs, subdirectory)
+        if not self.manifest.load():
+            # Pick up any posts copied into the bucket directly
+            self.manifest.rebuild()
+        self.lowest_id = self.manifest.get_lowest_id()
 
         if self.lowest_id:
-            images_to_post = self.get_images_with_same_id(self.lowest_id, file_names)
+            images_to_post = self.manifest.get_images(self.lowest_id)
             logger.info(f"Images to post: {images_to_post}")
         else:
             logger.info("No images to post! Exiting...")
 
         return images_to_post
+
+    def remove_posted(self, id: int):
+        """Drop a posted id from the queue manifest once its blobs are deleted"""
+        if self.manifest is not None:
+            self.manifest.remove_post(id)
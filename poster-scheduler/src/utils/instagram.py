@@ -1,12 +1,20 @@
 import time
+import json
 import os
-from datetime import datetime
+import hashlib
+from typing import Iterable
 from enum import auto, Enum
-from functools import cache
 from pathlib import Path
 from tenacity import retry, stop_after_attempt, wait_random
 from src.utils.cloud_storage import CloudStorageAdapter
+from src.utils.blob_cache import JsonBlobCache
+from src.utils.highlights import HighlightRegistry
+from src.utils.proxies import PROXY_EXCEPTIONS, failed_to_connect, get_shared_pool
+from src.utils.rate_limit import RateLimitedClient
+from src.utils.upload_progress import AlbumUploadProgress
 from instagrapi import Client
+from instagrapi.exceptions import ClientError, LoginRequired
+from instagrapi.extractors import extract_media_v1
 from instagrapi.types import (
     Location,
     StoryHashtag,
@@ -14,6 +22,7 @@ from instagrapi.types import (
     Media,
     Story,
     Highlight,
+    Hashtag,
 )
 from src.utils.misc import get_credentials_secret, get_current_service_account
 import logging
@@ -29,6 +38,20 @@ logger = logging.getLogger("insta_poster_logger")
 
 POST_DELAY_MIN = 4
 POST_DELAY_MAX = 7
+SESSION_TTL = 60 * 60  # Seconds a validated session is reused without a check
+# Set by Cloud Run, above 0 when an earlier attempt of this run failed
+TASK_ATTEMPT = int(os.getenv("CLOUD_RUN_TASK_ATTEMPT", 0))
+LOCATION_CACHE_TTL = 30 * 24 * 60 * 60
+HASHTAG_CACHE_TTL = 90 * 24 * 60 * 60
+VERIFY_TIMEOUT = 60
+VERIFY_RETRY_DELAY = 5
+VERIFY_PAGE_SIZE = 6
+MEDIA_PAGE_SIZE = 12
+ALBUM_MEDIA_TYPE = 8
+MAX_ITEM_ATTEMPTS = 3
+CONFIGURE_ATTEMPTS = 10
+CONFIGURE_DELAY = 3
+CONFIGURE_CLOCK_SKEW = 5 * 60
 TEST_ACCOUNTS = []
 TEST_ACCOUNT = TEST_ACCOUNTS[1]
 
@@ -52,21 +75,30 @@ class InstagramAdapter:
     ):
         self.media = None
         self.username = None
+        self.user_id = None
+        self.validated_at = 0
         self.bucket = bucket
         self.account = account
         self.upload_type = upload_type
         self.gcs = CloudStorageAdapter(bucket)
         get_current_service_account()
         self.session_path = Path(f"{account}/session.json")
+        self.location_cache = JsonBlobCache(
+            self.gcs, Path(f"{account}/locations.json"), ttl=LOCATION_CACHE_TTL
+        )
+        self.hashtag_cache = JsonBlobCache(
+            self.gcs, Path(f"{account}/hashtags.json"), ttl=HASHTAG_CACHE_TTL
+        )
         if login:
             self.project = project
-            self.cl = Client(delay_range=[2, 5])
+            # Calls are paced by the shared limiter rather than a fixed delay
+            self.cl = RateLimitedClient(Client(), proxy_pool=get_shared_pool())
+            self.cl.set_proxy(self.next_proxy())
             self.setup_connection()
-            self.user_id = self.cl.user_id_from_username(self.username)
         self.highlight = highlight
         self.highlight_pk_path = Path(f"{account}/highlights.json")
+        self.highlights = HighlightRegistry(self.gcs, self.highlight_pk_path)
         self.story = None
-        self.date_fmt = "%y-%m-%d %H:%M:%S"
 
     def setup_connection(self):
         test_acct = True if self.account == "test" else False
@@ -74,16 +106,44 @@ class InstagramAdapter:
         if test_acct:
             self.username = TEST_ACCOUNT
 
-        if self.gcs.blob_exists(self.session_path):
+        session = self.load_session()
+        if session:
             logger.info("Previous session found, using to log in...")
-            self.relogin(password)
+            self.cl.set_settings(session)
+            self.user_id = session.get("user_id")
+            self.validated_at = session.get("validated_at", 0)
+            self.check_login(password)
         else:
             self.fresh_login(password)
 
-        self.check_login(password)
+        if not self.user_id:
+            self.user_id = self.cl.user_id or self.cl.user_id_from_username(
+                self.username
+            )
+        # Only write the session back if it was validated or is new
+        if not session or (
+            session.get("validated_at") != self.validated_at
+            or session.get("user_id") != self.user_id
+        ):
+            self.save_session()
+
+    def load_session(self) -> dict | None:
+        session = self.gcs.download_blob_if_exists(self.session_path)
+        return json.loads(session) if session else None
+
+    def save_session(self):
+        """Save the session with the user id and when it was last validated"""
+        settings = self.cl.get_settings()
+        settings["user_id"] = self.user_id
+        settings["validated_at"] = self.validated_at
+        self.gcs.upload_json(self.session_path, settings)
+
+    def invalidate_session(self):
+        """Have the next run check the session instead of trusting it"""
+        self.validated_at = 0
+        self.save_session()
 
     def fresh_login(self, password: str):
-        self.session_path.parent.mkdir(exist_ok=True, parents=True)
         settings = self.cl.get_settings()
         settings["country"] = "GB"
         settings["country_code"] = 44
@@ -102,7 +162,7 @@ class InstagramAdapter:
         {settings["device_settings"]["dpi"]}; {settings["device_settings"]["resolution"]}; OnePlus;\
          {settings["device_settings"]["model"]}; devitron; qcom; {settings["locale"]}; 314665256)'
 
-        self.gcs.upload_json(self.session_path, settings)
+        self.cl.set_settings(settings)
         self.login(self.username, password, relogin=False)
 
     def relogin(self, password: str):
@@ -115,23 +175,33 @@ class InstagramAdapter:
             self.cl.login(username, password, relogin=relogin)
         except:
             raise ValueError("Could not log in!")
+        self.validated_at = time.time()
 
     @retry(stop=stop_after_attempt(1), wait=wait_random(min=3, max=6))
     def check_login(self, password: str):
-        logger.info("Attempting relogin...")
-        self.relogin(password)
+        """Reuse the loaded session if it is still valid, only logging in if not"""
+        # A retried run may have failed on this very session, so always check it
+        recent = time.time() - self.validated_at < SESSION_TTL
+        if self.user_id and recent and not TASK_ATTEMPT:
+            logger.info("Session validated recently, reusing it.")
+            return
+        try:
+            # Cheap authenticated call, also gives the user id
+            self.user_id = self.cl.account_info().pk
+            self.validated_at = time.time()
+            logger.info("Session still valid, reusing it.")
+        except (LoginRequired, ClientError):
+            logger.info("Session expired, attempting relogin...")
+            self.login(self.username, password, relogin=True)
 
     @staticmethod
-    def next_proxy() -> str:
+    def next_proxy() -> str | None:
         """Does not need instagram to be logged in"""
+        pool = get_shared_pool()
+        if pool is None:
+            return None
         logger.info("Changing proxy...")
-        return random.choice(
-            [
-                "http://123.com",
-                "http://123.com",
-                "http://123.com",
-            ]
-        )
+        return pool.choose()
 
     def parse_json_contents(self, contents: str) -> tuple[str]:
         """Does not need instagram to be logged in"""
@@ -171,10 +241,16 @@ class InstagramAdapter:
         hashtags: str = None,
         highlight: str = None,
     ):
+        story_ids = []
         for idx, file_name in enumerate(file_names):
             self.upload_picture_to_story(
-                _path, file_name, idx, caption, loc_obj, hashtags, highlight
+                _path, file_name, idx, caption, loc_obj, hashtags
             )
+            story_ids.append(self.story.id)
+
+        # Attach every story to the highlight in a single call
+        if highlight:
+            self.add_stories_to_highlight(story_ids, highlight, loc_obj, caption)
 
     def upload_picture_to_story(
         self,
@@ -184,32 +260,16 @@ class InstagramAdapter:
         caption: str = None,
         loc_obj: Location = None,
         hashtags: str = None,
-        highlight: str = None,
-    ):
+    ) -> Story:
         file_path = path_.joinpath(file_name)
         first_image = idx == 0
-        # time.sleep(random.randint(POST_DELAY_MIN, POST_DELAY_MAX))  # Small delay between story uploads
         # First image differs as we need to add hashtag and location stickers to it
         if first_image:
             self.create_new_story(hashtags, file_name, file_path, loc_obj)
-            if highlight:
-                if highlight == "new":
-                    self.create_new_highlight(loc_obj, caption, file_name)
-
-                else:
-                    self.add_to_existing_highlight(highlight, file_name)
         else:
             logger.info(f"Uploading '{file_name}' to story...")
             self.story = self.cl.photo_upload_to_story(file_path)
-
-            if highlight:
-                if highlight == "new":
-                    logger.info(
-                        f"Adding '{file_name}' story to highlight with pk '{self.highlight.pk}'..."
-                    )
-                    self.cl.highlight_add_stories(self.highlight.pk, [self.story.id])
-                else:
-                    self.add_to_existing_highlight(highlight, file_name)
+        return self.story
 
     def create_new_story(
         self, hashtags: str, file_name: str, file_path: str, loc_obj: Location
@@ -226,73 +286,58 @@ class InstagramAdapter:
             path=file_path, hashtags=hashtag_objs, locations=loc_story_obj
         )
 
-    def create_new_highlight(self, loc_obj: Location, caption: str, file_name: str):
+    def add_stories_to_highlight(
+        self,
+        story_ids: list[str],
+        highlight: str,
+        loc_obj: Location = None,
+        caption: str = None,
+    ):
+        if highlight == "new":
+            self.create_new_highlight(loc_obj, caption, story_ids)
+        else:
+            self.add_to_existing_highlight(highlight, story_ids)
+
+    def create_new_highlight(
+        self, loc_obj: Location, caption: str, story_ids: list[str]
+    ):
         # We also need to add the new highlight PK to our database
-        logger.info(f"Adding '{file_name}' story to highlight...")
-        # hc_args = {
-        #     "title": "" if not loc_obj else loc_obj.name,
-        #     "story_ids": [self.story.id],
-        # }
-        print(self.story.id)
+        logger.info(f"Adding {len(story_ids)} stories to new highlight...")
         self.highlight = self.cl.highlight_create(
-            title="" if not loc_obj else loc_obj.name, story_ids=[self.story.id]
+            title="" if not loc_obj else loc_obj.name, story_ids=story_ids
         )
-        self.save_highlight_pk(self.highlight.pk, self.story.id, caption)
+        self.save_highlight_pk(self.highlight.pk, story_ids[0], caption)
         logger.info(f"Highlight pk is: '{self.highlight.pk}'.")
 
-    def add_to_existing_highlight(self, highlight: str, file_name: str):
+    def add_to_existing_highlight(self, highlight: str, story_ids: list[str]):
         if highlight == "latest":
             latest_highlight = self.get_latest_highlight_pk()
             logger.info(
-                f"Adding '{file_name}' story to latest highlight {latest_highlight}..."
+                f"Adding {len(story_ids)} stories to latest highlight {latest_highlight}..."
             )
-            self.cl.highlight_add_stories(latest_highlight, [self.story.id])
+            self.cl.highlight_add_stories(latest_highlight, story_ids)
 
         elif highlight.isnumeric():
             self.validate_highlight_pk(highlight)
             logger.info(
-                f"Adding '{file_name}' story to highlight existing {highlight}..."
+                f"Adding {len(story_ids)} stories to existing highlight {highlight}..."
             )
-            self.cl.highlight_add_stories(highlight, [self.story.id])
+            self.cl.highlight_add_stories(highlight, story_ids)
 
     def save_highlight_pk(self, highlight_pk: str, story_id: str, caption: str):
-        highlight_pks = {}
-        if self.highlight_pk_path in self.gcs.list_blobs(self.highlight_pk_path):
-            highlight_pks = self.gcs.download_json_blob(self.highlight_pk_path)
-
-        highlight_pks[highlight_pk] = {
-            "story_id": story_id,
-            "caption": caption,
-            "created_at": datetime.now().strftime(self.date_fmt),
-        }
-        self.gcs.upload_json(self.highlight_pk_path, highlight_pks)
+        self.highlights.add(highlight_pk, story_id, caption)
 
     def validate_highlight_pk(self, highlight_pk) -> bool:
-        if self.highlight_pk_path not in self.gcs.list_blobs(self.highlight_pk_path):
+        if not self.highlights.exists():
             raise FileExistsError(f"File {self.highlight_pk_path} not found!")
-        else:
-            highlight_pks = self.gcs.download_json_blob(self.highlight_pk_path)
 
-        if highlight_pk not in highlight_pks:
+        if highlight_pk not in self.highlights:
             raise ValueError(f"Highlight PK {highlight_pk} not found!")
 
         return True
 
-    @cache
     def get_latest_highlight_pk(self) -> str:
-        highlight_pks = self.gcs.download_json_blob(self.highlight_pk_path)
-        max_highlight_pk = None
-        max_created_at = None
-        for highlight_pk, content in highlight_pks.items():
-            created_at = datetime.strptime(content["created_at"], self.date_fmt)
-            if max_created_at is None:
-                max_created_at = created_at
-                max_highlight_pk = highlight_pk
-            if created_at > max_created_at:
-                max_created_at = created_at
-                max_highlight_pk = highlight_pk
-
-        return max_highlight_pk
+        return self.highlights.get_latest_pk()
 
     def get_story_hashtag_list(self, hashtags: list[str]) -> list[StoryHashtag]:
         logger.info("Creating StoryHashtag list...")
@@ -302,17 +347,25 @@ class InstagramAdapter:
         for tag in hashtags[:num_tags]:
             story_hashtags.append(
                 StoryHashtag(
-                    hashtag=self.cl.hashtag_info(tag),
+                    hashtag=self.get_hashtag(tag),
                     x=random.randint(10, 200),
                     y=random.randint(10, 200),
                     width=10,
                     height=10,
                 )
             )
-            time.sleep(random.randint(POST_DELAY_MIN, POST_DELAY_MAX))
 
         return story_hashtags
 
+    def get_hashtag(self, tag: str) -> Hashtag:
+        """Look a hashtag up in the cache, only asking Instagram on a miss"""
+        hashtag_info = self.hashtag_cache.get(tag)
+        if hashtag_info is None:
+            hashtag = self.cl.hashtag_info(tag)
+            hashtag_info = {"id": str(hashtag.id), "name": hashtag.name}
+            self.hashtag_cache.put(tag, hashtag_info)
+        return Hashtag(**hashtag_info)
+
     def upload_picture(self, _path, file_name, caption=None, loc_obj=None):
         file_path = _path.joinpath(file_name)
         self.media = self.cl.photo_upload(
@@ -323,21 +376,122 @@ class InstagramAdapter:
             raise AssertionError("Instagram picture upload failed!")
 
     def upload_album(self, path_, file_names, caption=None, loc_obj=None):
-        paths = []
-        for file in file_names:
-            paths.append(os.path.join(path_, file))
-        self.media = self.cl.album_upload(
-            paths=paths, caption=caption, location=loc_obj
-        )
+        """
+        Upload each item of the album on its own, saving progress as it goes,
+        then configure them into one post. A retried job picks up the saved
+        progress, so only items that failed are uploaded again.
+        """
+        progress = self.get_album_progress(file_names)
+        progress.load()
+        if progress.media_pk is None:
+            self.upload_album_items(path_, file_names, progress)
+            children = [progress.children[file] for file in file_names]
+            self.media = self.configure_album(children, caption, loc_obj)
+            progress.set_media_pk(self.media.pk)
+        else:
+            logger.info(f"Album already configured as {progress.media_pk}.")
+            self.media = self.cl.media_info(progress.media_pk)
+
         if not self.successful_upload(pk=self.media.pk):
             raise AssertionError("Instagram album upload failed!")
+        progress.clear()
+
+    def get_album_progress(self, file_names: list[str]) -> AlbumUploadProgress:
+        key = hashlib.sha256(json.dumps(list(file_names)).encode("utf-8")).hexdigest()
+        return AlbumUploadProgress(
+            self.gcs, Path(f"{self.account}/uploads/{key[:16]}.json")
+        )
+
+    def upload_album_items(
+        self, path_, file_names: list[str], progress: AlbumUploadProgress
+    ):
+        """Upload the items not uploaded yet, raising once all have been tried"""
+        failed = []
+        for file in file_names:
+            if file in progress.children:
+                logger.info(f"'{file}' already uploaded, skipping.")
+                continue
+            for attempt in range(MAX_ITEM_ATTEMPTS):
+                try:
+                    progress.add_child(file, self.upload_album_item(Path(path_, file)))
+                    break
+                except ClientError as e:
+                    logger.warning(f"Upload of '{file}' failed (attempt {attempt + 1}): {e}")
+            else:
+                failed.append(file)
+
+        if failed:
+            raise AssertionError(f"Could not upload album items {failed}!")
+
+    def upload_album_item(self, file_path: Path) -> dict:
+        upload_id, width, height = self.cl.photo_rupload(file_path, to_album=True)
+        return {
+            "upload_id": upload_id,
+            "edits": json.dumps(
+                {
+                    "crop_original_size": [width, height],
+                    "crop_center": [0.0, -0.0],
+                    "crop_zoom": 1.0,
+                }
+            ),
+            "extra": json.dumps({"source_width": width, "source_height": height}),
+            "scene_capture_type": "",
+            "scene_type": None,
+        }
+
+    def configure_album(self, children: list[dict], caption=None, loc_obj=None):
+        started_at = time.time()
+        for _ in range(CONFIGURE_ATTEMPTS):
+            time.sleep(CONFIGURE_DELAY)
+            try:
+                configured = self.cl.album_configure(
+                    children, caption, location=loc_obj
+                )
+            except PROXY_EXCEPTIONS as e:
+                # Only configure again once sure the album was not posted
+                if not failed_to_connect(e):
+                    media = self.find_configured_album(
+                        caption, len(children), started_at
+                    )
+                    if media is not None:
+                        logger.info(f"Album was configured as {media.pk} anyway.")
+                        return media
+                logger.warning(f"Configuring the album failed ({e}), retrying...")
+                continue
+            except ClientError as e:
+                if "Transcode not finished yet" in str(e):
+                    continue
+                raise
+            if configured and configured.get("media"):
+                return extract_media_v1(configured["media"])
+        raise AssertionError("Could not configure Instagram album!")
+
+    def find_configured_album(
+        self, caption: str, num_items: int, since: float
+    ) -> Media | None:
+        """Look for an album configured since 'since' whose response was lost"""
+        medias, _ = self.cl.user_medias_paginated(self.user_id, amount=VERIFY_PAGE_SIZE)
+        for media in medias:
+            if (
+                media.media_type == ALBUM_MEDIA_TYPE
+                and len(media.resources) == num_items
+                and (media.caption_text or "").strip() == (caption or "").strip()
+                and media.taken_at.timestamp() >= since - CONFIGURE_CLOCK_SKEW
+            ):
+                return media
+        return None
 
     def get_location_obj(self, location: str) -> Location:
-        loc_info = {}
-        keys_required = ["pk", "name", "lng", "lat"]
-        search_info = dict(self.cl.fbsearch_places(location)[0])
-        for key in keys_required:
-            loc_info[key] = search_info[key]
+        loc_info = self.location_cache.get(location)
+        if loc_info is None:
+            loc_info = {}
+            keys_required = ["pk", "name", "lng", "lat"]
+            search_info = dict(self.cl.fbsearch_places(location)[0])
+            for key in keys_required:
+                loc_info[key] = search_info[key]
+            self.location_cache.put(location, loc_info)
+        else:
+            logger.info(f"Found location '{location}' in cache.")
         return Location(
             pk=loc_info["pk"],
             name=loc_info["name"],
@@ -350,23 +504,48 @@ class InstagramAdapter:
         self.cl.media_comment(id, comment)
 
     def successful_upload(self, pk: str) -> bool:
-        user_id = self.cl.user_id_from_username(self.username)
-        user_medias = self.cl.user_medias(user_id=user_id)
-        for media in user_medias:
-            if pk == media.pk:
-                return True
-        return False
+        """
+        Look the new media up by pk, falling back to the newest page of the
+        user's media, retrying until VERIFY_TIMEOUT as it can take a moment to
+        show up. Costs the same however many posts the account has.
+        """
+        deadline = time.monotonic() + VERIFY_TIMEOUT
+        while True:
+            try:
+                media = self.cl.media_info(pk)
+                if not self.user_id or str(media.user.pk) == str(self.user_id):
+                    return True
+            except ClientError:
+                pass
+            if self.user_id:
+                try:
+                    medias, _ = self.cl.user_medias_paginated(
+                        self.user_id, amount=VERIFY_PAGE_SIZE
+                    )
+                    if any(str(media.pk) == str(pk) for media in medias):
+                        return True
+                except ClientError:
+                    pass
+            if time.monotonic() + VERIFY_RETRY_DELAY > deadline:
+                return False
+            time.sleep(VERIFY_RETRY_DELAY)
 
     def list_users_media(self, media_type: InstagramType, user_id: str = ""):
+        """
+        Yield the user's media of a type, fetching posts and albums a page at a
+        time so callers can stop early. Stories and highlights come in one page.
+        """
         if not user_id:
             user_id = self.user_id
         match media_type:
             case InstagramType.POST:
-                for media in self.cl.user_medias(user_id):
-                    yield media
+                for media in self.page_users_medias(user_id):
+                    if media.media_type != ALBUM_MEDIA_TYPE:
+                        yield media
             case InstagramType.ALBUM:
-                for media in self.cl.user_medias(user_id):
-                    yield media
+                for media in self.page_users_medias(user_id):
+                    if media.media_type == ALBUM_MEDIA_TYPE:
+                        yield media
             case InstagramType.STORY:
                 for media in self.cl.user_stories(user_id):
                     yield media
@@ -374,6 +553,25 @@ class InstagramAdapter:
                 for media in self.cl.user_highlights(user_id):
                     yield media
 
+    def page_users_medias(self, user_id: str, page_size: int = MEDIA_PAGE_SIZE):
+        end_cursor = ""
+        while True:
+            medias, end_cursor = self.cl.user_medias_paginated(
+                user_id, amount=page_size, end_cursor=end_cursor
+            )
+            yield from medias
+            if not medias or not end_cursor:
+                return
+
+    def delete_users_medias(self, medias: Iterable) -> int:
+        """
+        Delete media as it is listed. One at a time, as the client is not
+        thread safe, paced by the rate limiter's write budget.
+        """
+        if self.account != "test":
+            return 0
+        return sum(bool(self.delete_users_media(media)) for media in medias)
+
     def delete_users_media(self, media):
         if self.account != "test":
             return
@@ -397,3 +595,4 @@ class InstagramAdapter:
             logger.info(f"Deleted {result_type} with id: {id}")
         else:
             logger.warning(f"Failed to delete {result_type} with id: {id}")
+        return result
@@ -1,31 +1,110 @@
+import functools
+import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import google.auth
 from google.cloud import secretmanager
 
+SECRET_TTL = 15 * 60
+# Set both to keep fetched secrets in an encrypted file, for long running processes
+LOCAL_SECRET_CACHE = os.getenv("LOCAL_SECRET_CACHE")
+SECRET_CACHE_KEY = os.getenv("SECRET_CACHE_KEY")
+
 logger = logging.getLogger("insta_poster_logger")
 
+# {secret name: (value, fetched at)}
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+@functools.cache
+def get_default_credentials() -> tuple:
+    """Resolve the application default credentials once per process"""
+    return google.auth.default()
+
+
+@functools.cache
+def get_secret_client() -> secretmanager.SecretManagerServiceClient:
+    credentials, _ = get_default_credentials()
+    return secretmanager.SecretManagerServiceClient(credentials=credentials)
+
+
+def read_local_secrets() -> dict:
+    if not (LOCAL_SECRET_CACHE and SECRET_CACHE_KEY):
+        return {}
+    path = Path(LOCAL_SECRET_CACHE)
+    if not path.is_file():
+        return {}
+    from cryptography.fernet import Fernet, InvalidToken
+
+    try:
+        secrets = Fernet(SECRET_CACHE_KEY).decrypt(path.read_bytes())
+    except InvalidToken:
+        logger.warning("Could not decrypt the local secret cache, ignoring it.")
+        return {}
+    return {name: tuple(entry) for name, entry in json.loads(secrets).items()}
+
+
+def write_local_secrets(secrets: dict):
+    if not (LOCAL_SECRET_CACHE and SECRET_CACHE_KEY):
+        return
+    from cryptography.fernet import Fernet
+
+    path = Path(LOCAL_SECRET_CACHE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(Fernet(SECRET_CACHE_KEY).encrypt(json.dumps(secrets).encode()))
+    path.chmod(0o600)
+
+
+def access_secret(name: str) -> str:
+    response = get_secret_client().access_secret_version(name=name)
+    return response.payload.data.decode("UTF-8")
+
+
+def get_secrets(names: list[str]) -> list[str]:
+    """
+    Get secret versions, fetching any not cached in the last SECRET_TTL
+    seconds from secret manager at the same time
+    """
+    with _secrets_lock:
+        if not _secrets:
+            _secrets.update(read_local_secrets())
+        now = time.time()
+        missing = [
+            name
+            for name in names
+            if name not in _secrets or now - _secrets[name][1] > SECRET_TTL
+        ]
+        if missing:
+            logger.info("Accessing credentials from secret manager...")
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                values = list(executor.map(access_secret, missing))
+            _secrets.update({name: (value, now) for name, value in zip(missing, values)})
+            write_local_secrets(_secrets)
+        return [_secrets[name][0] for name in names]
+
 
 def get_credentials_secret(
     test_acct: bool = True, project_id: str = None
 ) -> tuple[str]:
-    client = secretmanager.SecretManagerServiceClient()
     account = "" if test_acct else ""
-    creds = []
-    logger.info("Accessing credentials from secret manager...")
-    for secret_id in [account, "password"]:
+    names = [
         # Build the resource name of the secret version.
-        name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-        # Access the secret version.
-        response = client.access_secret_version(name=name)
-        # Return the decoded payload.
-        creds.append(response.payload.data.decode("UTF-8"))
+        f"projects/{project_id}/secrets/{secret_id}/versions/latest"
+        for secret_id in [account, "password"]
+    ]
+    username, password = get_secrets(names)
     logger.info("Found credentials!")
 
-    return creds[0], creds[1]
+    return username, password
 
 
 def get_current_service_account():
-    import google.auth
-    credentials, project_id = google.auth.default()
+    credentials, project_id = get_default_credentials()
     if hasattr(credentials, "service_account_email"):
         logger.info(f"Service account in use: {credentials.service_account_email}")
     else:
@@ -0,0 +1,151 @@
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable
+import requests
+from urllib3.exceptions import NewConnectionError
+from instagrapi.exceptions import (
+    ClientConnectionError,
+    ClientRequestTimeout,
+    ProxyAddressIsBlocked,
+)
+
+EWMA_ALPHA = 0.3
+EVICT_BELOW_SUCCESS_RATE = 0.5
+EVICT_SECONDS = 5 * 60
+PROBE_INTERVAL = 60
+PROBE_URL = "https://i.instagram.com/"
+PROBE_TIMEOUT = 10
+PROXY_EXCEPTIONS = (
+    ClientConnectionError,
+    ClientRequestTimeout,
+    ProxyAddressIsBlocked,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+# Raised before the request was sent, so even calls that post are safe to repeat
+CONNECT_EXCEPTIONS = (
+    ProxyAddressIsBlocked,
+    requests.exceptions.ConnectTimeout,
+    requests.exceptions.ProxyError,
+)
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+def failed_to_connect(error: Exception) -> bool:
+    """
+    Whether a transport error happened before the request reached Instagram.
+    Read timeouts and dropped connections may come after it was acted on.
+    """
+    if isinstance(error, ClientConnectionError) and error.__context__:
+        # instagrapi wraps the requests error without keeping its type
+        error = error.__context__
+    if isinstance(error, CONNECT_EXCEPTIONS):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+@dataclass
+class ProxyStats:
+    success_rate: float = 1.0
+    latency: float = 1.0
+    evicted_until: float = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return self.evicted_until <= now
+
+
+def probe_proxy(proxy: str) -> float:
+    """Time a request through the proxy, raises if it fails"""
+    start = time.monotonic()
+    response = requests.head(
+        PROBE_URL, proxies={"http": proxy, "https": proxy}, timeout=PROBE_TIMEOUT
+    )
+    response.raise_for_status()
+    return time.monotonic() - start
+
+
+class ProxyPool:
+    """
+    Proxies with an exponentially weighted success rate and latency each. Any
+    that drop below EVICT_BELOW_SUCCESS_RATE are left out for EVICT_SECONDS.
+    choose() picks a healthy proxy at random weighted by success rate over
+    latency, so the fastest reliable proxy is picked most often. Stats come from
+    real calls through record() and from probing in the background.
+    """
+
+    def __init__(self, proxies: list[str], probe: Callable[[str], float] = probe_proxy):
+        self.stats = {proxy: ProxyStats() for proxy in proxies}
+        self.probe = probe
+        self.lock = threading.Lock()
+        self.stop_probing = threading.Event()
+        self.probe_thread = None
+
+    def choose(self, exclude: str = None) -> str:
+        now = time.monotonic()
+        with self.lock:
+            candidates = [
+                (proxy, stats)
+                for proxy, stats in self.stats.items()
+                if stats.healthy(now) and proxy != exclude
+            ]
+            if not candidates:
+                # Everything is evicted, use whichever comes back soonest
+                return min(self.stats, key=lambda proxy: self.stats[proxy].evicted_until)
+            weights = [stats.success_rate / max(stats.latency, 0.01) for _, stats in candidates]
+            return random.choices([proxy for proxy, _ in candidates], weights=weights)[0]
+
+    def record(self, proxy: str, success: bool, latency: float = None):
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            stats.success_rate += EWMA_ALPHA * (float(success) - stats.success_rate)
+            if success and latency is not None:
+                stats.latency += EWMA_ALPHA * (latency - stats.latency)
+            if stats.success_rate < EVICT_BELOW_SUCCESS_RATE:
+                stats.evicted_until = time.monotonic() + EVICT_SECONDS
+                # Give it a fresh start once it comes back
+                stats.success_rate = EVICT_BELOW_SUCCESS_RATE
+                logger.warning(f"Evicting proxy '{proxy}' for {EVICT_SECONDS}s")
+
+    def probe_all(self):
+        for proxy in list(self.stats):
+            try:
+                self.record(proxy, True, self.probe(proxy))
+            except Exception as e:
+                logger.info(f"Proxy '{proxy}' failed probe: {e}")
+                self.record(proxy, False)
+
+    def start_probing(self, interval: float = PROBE_INTERVAL):
+        if self.probe_thread is not None:
+            return
+
+        def _probe_loop():
+            while not self.stop_probing.is_set():
+                self.probe_all()
+                self.stop_probing.wait(interval)
+
+        self.probe_thread = threading.Thread(target=_probe_loop, daemon=True)
+        self.probe_thread.start()
+
+
+@functools.cache
+def get_shared_pool() -> ProxyPool | None:
+    """Pool of the comma separated INSTAGRAM_PROXIES, None when not set"""
+    proxies = [
+        proxy.strip()
+        for proxy in os.getenv("INSTAGRAM_PROXIES", "").split(",")
+        if proxy.strip()
+    ]
+    if not proxies:
+        return None
+    pool = ProxyPool(proxies)
+    pool.start_probing()
+    return pool
@@ -0,0 +1,189 @@
+import functools
+import logging
+import threading
+import time
+from typing import Callable
+from instagrapi.exceptions import (
+    ChallengeRequired,
+    ClientThrottledError,
+    FeedbackRequired,
+    PleaseWaitFewMinutes,
+    RateLimitError,
+)
+from src.utils.proxies import PROXY_EXCEPTIONS, ProxyPool
+
+# Sustained calls per second and burst size for each class of endpoint
+ENDPOINT_BUDGETS = {
+    # Raw media bytes, an album sends one per item before a single configure
+    "transfer": (1, 10),
+    "upload": (1 / 8, 2),
+    "write": (1 / 4, 3),
+    "search": (1 / 4, 3),
+    "read": (1 / 2, 5),
+}
+UNLIMITED_METHODS = ["get_settings", "set_settings", "set_proxy", "set_device"]
+THROTTLED_EXCEPTIONS = (PleaseWaitFewMinutes, RateLimitError, ClientThrottledError)
+CHALLENGE_EXCEPTIONS = (ChallengeRequired, FeedbackRequired)
+MAX_THROTTLED_RETRIES = 2
+THROTTLED_BACKOFF = 30  # Seconds, doubled on each retry
+MAX_PROXY_ROTATIONS = 2
+# Only calls that are safe to repeat are retried on a new proxy
+PROXY_RETRY_ENDPOINTS = ["read", "search"]
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class TokenBucket:
+    """
+    Token bucket allowing bursts of up to 'burst' calls, refilled at 'rate'
+    calls per second. acquire() blocks only once the burst is used up, rather
+    than sleeping a fixed time after every call. If given a 'min_rate' the rate
+    adapts, halving on backoff() down to it and creeping back up on recover().
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = None):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate or rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self) -> float:
+        """Take a token, waiting for one if needed, returns the time waited"""
+        with self.lock:
+            self.refill()
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def backoff(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class InstagramRateLimiter:
+    """
+    One token bucket per class of Instagram endpoint. Every call waits for a
+    token from its bucket, backs off and retries when throttled, and slows all
+    buckets down when Instagram asks for a challenge.
+    """
+
+    def __init__(self, budgets: dict = None):
+        budgets = budgets or ENDPOINT_BUDGETS
+        self.buckets = {
+            endpoint: TokenBucket(rate, burst, min_rate=rate / 8)
+            for endpoint, (rate, burst) in budgets.items()
+        }
+
+    @staticmethod
+    def get_endpoint(method: str) -> str:
+        if "rupload" in method:
+            return "transfer"
+        if "upload" in method or method.startswith("album_"):
+            return "upload"
+        if method.startswith(("hashtag_", "fbsearch_", "search_", "location_search")):
+            return "search"
+        if any(
+            action in method
+            for action in ["delete", "create", "add", "comment", "like", "login"]
+        ):
+            return "write"
+        return "read"
+
+    def call(self, method: str, func: Callable, *args, **kwargs):
+        bucket = self.buckets[self.get_endpoint(method)]
+        for attempt in range(MAX_THROTTLED_RETRIES + 1):
+            bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except THROTTLED_EXCEPTIONS:
+                bucket.backoff()
+                if attempt == MAX_THROTTLED_RETRIES:
+                    raise
+                delay = THROTTLED_BACKOFF * 2**attempt
+                logger.warning(f"Throttled on '{method}', retrying in {delay}s...")
+                time.sleep(delay)
+                continue
+            except CHALLENGE_EXCEPTIONS:
+                logger.warning(f"Challenged on '{method}', slowing down all calls.")
+                for other_bucket in self.buckets.values():
+                    other_bucket.backoff()
+                raise
+            bucket.recover()
+            return result
+
+
+@functools.cache
+def get_shared_limiter() -> InstagramRateLimiter:
+    """The limiter used by every client in this process"""
+    return InstagramRateLimiter()
+
+
+class RateLimitedClient:
+    """
+    Wraps an instagrapi Client so every public method call goes through the
+    limiter. Given a proxy pool, the outcome and latency of each call are
+    recorded against the client's proxy and the client moves to another proxy
+    when a call fails to connect.
+    """
+
+    def __init__(
+        self,
+        client,
+        limiter: InstagramRateLimiter = None,
+        proxy_pool: ProxyPool = None,
+    ):
+        object.__setattr__(self, "client", client)
+        object.__setattr__(self, "limiter", limiter or get_shared_limiter())
+        object.__setattr__(self, "proxy_pool", proxy_pool)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name.startswith("_") or name in UNLIMITED_METHODS:
+            return attr
+
+        @functools.wraps(attr)
+        def limited(*args, **kwargs):
+            if self.proxy_pool is None:
+                return self.limiter.call(name, attr, *args, **kwargs)
+            return self.call_through_proxy(name, attr, *args, **kwargs)
+
+        return limited
+
+    def __setattr__(self, name: str, value):
+        setattr(self.client, name, value)
+
+    def call_through_proxy(self, method: str, func: Callable, *args, **kwargs):
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            result = func(*args, **kwargs)
+            self.proxy_pool.record(proxy, True, time.monotonic() - start)
+            return result
+
+        retry = self.limiter.get_endpoint(method) in PROXY_RETRY_ENDPOINTS
+        for attempt in range(MAX_PROXY_ROTATIONS + 1):
+            proxy = getattr(self.client, "proxy", None)
+            try:
+                return self.limiter.call(method, timed, *args, **kwargs)
+            except PROXY_EXCEPTIONS:
+                self.proxy_pool.record(proxy, False)
+                new_proxy = self.proxy_pool.choose(exclude=proxy)
+                logger.warning(f"'{method}' failed through proxy, moving to another...")
+                self.client.set_proxy(new_proxy)
+                if not retry or attempt == MAX_PROXY_ROTATIONS:
+                    raise
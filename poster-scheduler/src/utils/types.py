@@ -14,3 +14,4 @@ class ImageDirectories:
     unprocessed: Path
     down_sampled: Path
     processed: Path
+    cache: Path = None
@@ -0,0 +1,68 @@
+import logging
+import time
+from pathlib import Path
+from google.api_core.exceptions import NotFound
+from src.utils.cloud_storage import CloudStorageAdapter
+
+# Instagram drops uploaded media that is not configured into a post for a while
+PROGRESS_TTL = 6 * 60 * 60
+
+logger = logging.getLogger("insta_poster_logger")
+
+
+class AlbumUploadProgress:
+    """
+    Progress of an album upload, stored as
+
+        {"started_at": ..., "children": {"12_0.jpg": {"upload_id": ...}},
+         "media_pk": None}
+
+    Each item is saved as soon as it is uploaded and the media pk once the
+    album is configured, so a retried job only uploads the items that are
+    missing and never posts the same album twice.
+    """
+
+    def __init__(self, gcs: CloudStorageAdapter, path: Path):
+        self.gcs = gcs
+        self.path = Path(path)
+        self.progress = None
+
+    def load(self) -> dict:
+        try:
+            progress, _ = self.gcs.download_json_blob_with_generation(self.path)
+        except NotFound:
+            progress = None
+        if progress and time.time() - progress["started_at"] > PROGRESS_TTL:
+            logger.info(f"Album upload progress '{self.path}' is stale, ignoring.")
+            progress = None
+        self.progress = progress or {
+            "started_at": time.time(),
+            "children": {},
+            "media_pk": None,
+        }
+        return self.progress
+
+    def save(self):
+        self.gcs.upload_json(self.path, self.progress)
+
+    @property
+    def children(self) -> dict:
+        return self.progress["children"]
+
+    @property
+    def media_pk(self) -> str | None:
+        return self.progress["media_pk"]
+
+    def add_child(self, file_name: str, child: dict):
+        self.children[file_name] = child
+        self.save()
+
+    def set_media_pk(self, media_pk: str):
+        self.progress["media_pk"] = str(media_pk)
+        self.save()
+
+    def clear(self):
+        try:
+            self.gcs.delete_blob(self.path)
+        except NotFound:
+            pass
@@ -4,7 +4,8 @@ from pathlib import Path
 from unittest.mock import patch
 import pytest
 from _pytest.fixtures import fixture
-from src.utils.image_utils import ImageChecker
+from PIL import Image
+from src.utils.image_utils import ImageChecker, get_size_from_header, refine_image
 
 LOCAL_BUCKET_DIR = Path("./tests/images")
 DOWNSAMPLED_DIR = LOCAL_BUCKET_DIR.joinpath("downsampled")
@@ -35,9 +36,18 @@ def ic():
     return ic
 
 
-def write_in_memory_image(image):
+def write_in_memory_image(image, format="JPEG"):
     buffer = io.BytesIO()
-    image.save(buffer, format="JPEG")
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("format", ["JPEG", "PNG"])
+def test_get_size_from_header(format):
+    """Only the first couple of KB are needed to read the size"""
+    image_bytes = write_in_memory_image(Image.new("RGB", (1200, 800)), format)
+    assert get_size_from_header(image_bytes[:2048]) == (1200, 800)
+    assert get_size_from_header(image_bytes[:10]) is None
 
 
 def test_down_sample_image(ic):
@@ -98,3 +108,86 @@ def test_add_captions(change_working_dir):
         ic.image.save(Path.joinpath(STORIES_DIR, f"test_add_border_ar_{ar}_{img}"))
 
     assert True
+
+
+def test_refine_image():
+    image_bytes = write_in_memory_image(Image.new("RGB", (3000, 2000)))
+    down_sampled, processed = refine_image(image_bytes, "post", target_ar=1.0)
+    assert Image.open(io.BytesIO(down_sampled)).size == (1080, 720)
+    assert Image.open(io.BytesIO(processed)).size == (1080, 1080)
+
+
+@pytest.mark.parametrize(
+    "upload_type, size",
+    [
+        ("post", (3000, 4000)),
+        ("post", (3000, 2000)),
+        ("post", (600, 400)),
+        ("story", (1000, 3000)),
+    ],
+)
+def test_refine_image_down_samples_like_baseline(upload_type, size):
+    """The archived copy keeps the original's aspect ratio and is never upscaled"""
+    image_bytes = write_in_memory_image(Image.new("RGB", size))
+    ic = ImageChecker(upload_type=upload_type)
+    ic.set_image(io.BytesIO(image_bytes))
+    if ic.image_too_large():
+        ic.down_sample_image()
+    expected = ic.image.size
+
+    target_ar = ic.get_border_aspect_ratio(size[0] / size[1])
+    down_sampled, _ = refine_image(image_bytes, upload_type, target_ar)
+    assert Image.open(io.BytesIO(down_sampled)).size == expected
+
+
+@pytest.mark.parametrize(
+    "size, target_ar", [((3000, 3000), 0.8), ((2000, 3000), 1.0), ((1080, 1350), 0.8)]
+)
+def test_refine_image_resamples_once(size, target_ar):
+    """Each output is resampled straight from the decoded original, never upscaled"""
+    image_bytes = write_in_memory_image(Image.new("RGB", size))
+    resize = Image.Image.resize
+    resized = []
+
+    def _resize(image, new_size, *args, **kwargs):
+        resized.append((image.size, tuple(new_size)))
+        return resize(image, new_size, *args, **kwargs)
+
+    with patch.object(Image.Image, "resize", autospec=True, side_effect=_resize):
+        _, processed = refine_image(image_bytes, "post", target_ar)
+
+    assert len(resized) <= 2
+    assert len({source for source, _ in resized}) <= 1
+    assert all(
+        source[0] >= new[0] and source[1] >= new[1] for source, new in resized
+    )
+    assert Image.open(io.BytesIO(processed)).size[0] == 1080
+
+
+@pytest.mark.parametrize("size", [(3000, 2000), (2000, 3000), (600, 400)])
+def test_fit_to_border_matches_add_border(size):
+    image_bytes = write_in_memory_image(Image.new("RGB", size))
+    ic = ImageChecker(upload_type="post")
+    ic.set_image(io.BytesIO(image_bytes))
+    if ic.image_too_large():
+        ic.down_sample_image()
+    expected = ic.add_border(target_ar=0.8)
+    expected_size = ic.image.size
+
+    ic.set_image(io.BytesIO(image_bytes))
+    assert ic.fit_to_border(target_ar=0.8) == expected
+    assert ic.image.size == expected_size
+
+
+def test_draft_image():
+    """JPEG decoding is scaled down by a power of two, never below the target"""
+    image_bytes = write_in_memory_image(Image.new("RGB", (4000, 3000)))
+    ic = ImageChecker(upload_type="post")
+    ic.set_image(io.BytesIO(image_bytes))
+    ic.draft_image((1080, 810))
+    assert ic.image.size == (2000, 1500)
+    assert (ic.width, ic.height) == (4000, 3000)
+
+    ic.fit_to_border(target_ar=1.0)
+    assert ic.down_sampled_image.size == (1080, 810)
+    assert ic.image.size == (1080, 1080)
@@ -1,8 +1,12 @@
+import io
 import logging
 import os
+import time
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 import pytest
+from google.api_core.exceptions import NotFound
+from PIL import Image
 from src.utils.log import setup_custom_logger
 from src.utils.cloud_storage import CloudStorageAdapter
 from src.utils.instagram import InstagramAdapter, InstagramType
@@ -83,8 +87,7 @@ def delete_instagram_content():
     print("\nDeleting instagram content...")
     insta = InstagramAdapter(BUCKET, ACCOUNT, UPLOAD_TYPE, PROJECT, HIGHLIGHT)
     for insta_type in InstagramType:
-        for media in insta.list_users_media(insta_type):
-            insta.delete_users_media(media)
+        insta.delete_users_medias(insta.list_users_media(insta_type))
 
 
 @pytest.fixture
@@ -119,18 +122,18 @@ def test_post_story_without_config(upload_files_to_bucket, setup_post):
 
 
 test_data = [
-    (0, "new", 0),
-    (1, "new", 1),
-    (0, "latest", 2),
-    (1, "latest", 3),
-    (0, "123", 4),
-    (1, "123", 5),
+    (1, "new", 0),
+    (3, "new", 1),
+    (1, "latest", 2),
+    (3, "latest", 3),
+    (1, "123", 4),
+    (3, "123", 5),
 ]
 
 expected_insta_cl = {
     "insta.cl.highlight_create": (
         1,
-        0,
+        1,
         0,
         0,
         0,
@@ -138,15 +141,15 @@ expected_insta_cl = {
     ),
     "insta.cl.photo_upload_to_story": (
         1,
+        3,
         1,
+        3,
         1,
-        1,
-        1,
-        1,
+        3,
     ),
     "insta.cl.highlight_add_stories": (
         0,
-        1,
+        0,
         1,
         1,
         1,
@@ -157,7 +160,7 @@ expected_insta_cl = {
 expected_insta = {
     "insta.save_highlight_pk": (
         1,
-        0,
+        1,
         0,
         0,
         0,
@@ -181,11 +184,11 @@ expected_insta = {
     ),
     "insta.get_story_hashtag_list": (
         1,
-        0,
         1,
-        0,
         1,
-        0,
+        1,
+        1,
+        1,
     ),
 }
 
@@ -194,10 +197,11 @@ expected_insta = {
 @patch("src.utils.instagram.CloudStorageAdapter")
 @patch("src.utils.instagram.logging")
 @pytest.mark.parametrize(
-    "idx, highlight, test_idx",
+    "num_images, highlight, test_idx",
     test_data,
 )
-def test_upload_picture_to_story(get_sa, gcs, logger, idx, highlight, test_idx):
+def test_upload_pictures_to_story(get_sa, gcs, logger, num_images, highlight, test_idx):
+    """Every story is attached to the highlight in a single call"""
     insta = InstagramAdapter(bucket=BUCKET, login=False)
     # Set up mock objects
     insta.cl = MagicMock()
@@ -206,10 +210,9 @@ def test_upload_picture_to_story(get_sa, gcs, logger, idx, highlight, test_idx):
     insta.highlight = MagicMock()
     insta.highlight.pk = 1234
 
-    insta.upload_picture_to_story(
-        path_=Path("test"),
-        file_name="test_file",
-        idx=idx,
+    insta.upload_pictures_to_story(
+        _path=Path("test"),
+        file_names=[f"test_file_{idx}" for idx in range(num_images)],
         hashtags=None,
         highlight=highlight,
     )
@@ -220,3 +223,112 @@ def test_upload_picture_to_story(get_sa, gcs, logger, idx, highlight, test_idx):
         call_count = eval(f"{func}.call_count")
         expected = expected_insta_cl[func][test_idx]
         assert call_count == expected
+
+
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_list_users_media_pages_lazily(get_sa, gcs):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.user_id = 42
+    insta.cl = MagicMock()
+    first_page = [MagicMock(media_type=1), MagicMock(media_type=8)]
+    insta.cl.user_medias_paginated.side_effect = [
+        (first_page, "cursor"),
+        ([MagicMock(media_type=1)], ""),
+    ]
+
+    posts = insta.list_users_media(InstagramType.POST)
+    assert next(posts) is first_page[0]
+    insta.cl.user_medias_paginated.assert_called_once()
+    assert len(list(posts)) == 1
+    assert insta.cl.user_medias_paginated.call_count == 2
+
+
+@patch("src.utils.instagram.time.sleep")
+@patch("src.utils.instagram.extract_media_v1")
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_upload_album_resends_only_missing_items(get_sa, gcs, extract_media, sleep):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.cl = MagicMock()
+    insta.successful_upload = MagicMock(return_value=True)
+    uploaded = {"upload_id": "1"}
+    insta.gcs.download_json_blob_with_generation.return_value = (
+        {"started_at": time.time(), "children": {"a.jpg": uploaded}, "media_pk": None},
+        1,
+    )
+    insta.cl.photo_rupload.return_value = ("2", 1080, 1350)
+
+    insta.upload_album(Path("test"), ["a.jpg", "b.jpg"], caption="caption")
+
+    insta.cl.photo_rupload.assert_called_once_with(Path("test", "b.jpg"), to_album=True)
+    children = insta.cl.album_configure.call_args.args[0]
+    assert [child["upload_id"] for child in children] == ["1", "2"]
+    insta.gcs.delete_blob.assert_called_once()
+
+
+def test_delete_posted_images_deletes_only_that_post():
+    app = InstaPosterApp(PROJECT, BUCKET, "test", "post", None)
+    app.gcs = MagicMock()
+    app.pm = MagicMock()
+    app.pm.manifest.get_images.return_value = ["1_0_a.jpg", "1_1_b.jpg"]
+    app.pm.manifest.get_config.return_value = "1.yaml"
+
+    app.delete_posted_images("1")
+
+    deleted = app.gcs.delete_many.call_args.args[0]
+    assert [path.name for path in deleted] == ["1_0_a.jpg", "1_1_b.jpg", "1.yaml"]
+    app.gcs.delete_all_blobs.assert_not_called()
+    app.pm.remove_posted.assert_called_once_with(1)
+
+
+@patch("src.main.DOWNLOAD_WINDOW", 2)
+@patch("src.main.MAX_PROCESS_WORKERS", 2)
+def test_refine_misses_keeps_order_with_bounded_window():
+    app = InstaPosterApp(PROJECT, BUCKET, "test", "post", None)
+    app.gcs = MagicMock()
+    app.gcs.map_concurrently.side_effect = lambda func, items, workers: [
+        func(item) for item in items
+    ]
+    sizes = [(300, 200), (200, 300), (250, 250)]
+    originals = []
+    for size in sizes:
+        buffer = io.BytesIO()
+        Image.new("RGB", size).save(buffer, format="JPEG")
+        originals.append(buffer.getvalue())
+    app.gcs.download_blob_as_bytes.side_effect = originals
+
+    refined = app.refine_misses(
+        [Path(f"{idx}.jpg") for idx in range(3)], 1.0, [None] * 3, [None] * 3
+    )
+
+    assert app.gcs.download_blob_as_bytes.call_count == 3
+    # Originals are fetched in parallel, a window at a time
+    assert [
+        (len(call.args[1]), call.args[2]) for call in app.gcs.map_concurrently.call_args_list
+    ] == [(2, 2), (1, 2)]
+    down_sampled_sizes = [Image.open(io.BytesIO(images[0])).size for images in refined]
+    assert down_sampled_sizes == sizes
+
+
+def test_refine_images_archives_only_cache_misses(tmp_path):
+    app = InstaPosterApp(PROJECT, BUCKET, "test", "post", None)
+    app.images_to_post = ["1_0_a.jpg", "1_1_b.jpg"]
+    app.local_processed_dir = tmp_path
+    app.insta = MagicMock()
+    app.gcs = MagicMock()
+    app.gcs.map_concurrently.side_effect = lambda func, items: [func(i) for i in items]
+    app.gcs.download_yaml_blob.side_effect = NotFound("no config")
+    app.probe_image_size = MagicMock(return_value=(1080, 1080))
+    app.cache = MagicMock()
+    app.cache.get_key.side_effect = ["hit", "miss"]
+    app.cache.get.side_effect = lambda key: (b"d", b"p") if key == "hit" else None
+    app.refine_misses = MagicMock(return_value=[(b"d2", b"p2")])
+    app.archive_refined_images = MagicMock()
+
+    app.refine_images()
+
+    uploads, cache_puts = app.archive_refined_images.call_args.args
+    assert [path.name for path, _ in uploads] == ["1_1_b.jpg", "1_1_b.jpg"]
+    assert cache_puts == [("miss", b"d2", b"p2")]
+    assert tmp_path.joinpath("1_0_a.jpg").read_bytes() == b"p"
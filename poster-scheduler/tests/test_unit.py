@@ -1,12 +1,29 @@
 import json
 import shutil
 import os
+import threading
 import time
+from datetime import datetime, timezone
 from pathlib import Path
+from unittest.mock import MagicMock, patch
 import pytest
+import requests
+from instagrapi.exceptions import (
+    ClientConnectionError,
+    ClientError,
+    PleaseWaitFewMinutes,
+)
+from instagrapi.types import Media
 from src.utils.cloud_storage import CloudStorageAdapter
 from src.utils.image_utils import PostManager, ImageChecker
 from src.utils.instagram import InstagramAdapter
+from src.utils.manifest import QueueManifest
+from src.utils.image_cache import DerivedImageCache
+from src.utils.blob_cache import JsonBlobCache
+from src.utils.highlights import HighlightRegistry
+from src.utils.rate_limit import TokenBucket, InstagramRateLimiter, RateLimitedClient
+from src.utils.proxies import ProxyPool, failed_to_connect
+from src.utils import misc
 
 BUCKET_DIR = "tests/image_bucket"
 UNPROCESSED_DIR = Path("tests/unprocessed")
@@ -104,3 +121,336 @@ def test_get_latest_highlight(highlight_pks):
     insta = InstagramAdapter(BUCKET, login=False)
     latest_pk = insta.get_latest_highlight_pk()
     assert latest_pk == "65456323"
+
+
+def test_highlight_registry(highlight_pks):
+    gcs = MagicMock()
+    gcs.download_json_blob_with_generation.return_value = (highlight_pks, 7)
+    gcs.upload_json.return_value = 8
+    registry = HighlightRegistry(gcs, Path("test/highlights.json"))
+
+    # Old flat format is indexed on read
+    assert registry.get_latest_pk() == "65456323"
+    assert "88564432" in registry
+    assert "1" not in registry
+
+    registry.add("99999999", "3213512221", "test5")
+    assert registry.get_latest_pk() == "99999999"
+    registry_json = gcs.upload_json.call_args.args[1]
+    assert registry_json["latest"] == "99999999"
+    assert len(registry_json["highlights"]) == 5
+    assert gcs.upload_json.call_args.kwargs["if_generation_match"] == 7
+
+
+def test_queue_manifest_rebuild_and_update():
+    gcs = MagicMock()
+    gcs.download_json_blob_with_generation.return_value = (None, 0)
+    gcs.upload_json.return_value = 1
+    gcs.list_blobs.return_value = [
+        "tests/unprocessed/6B_DSF3994.jpg",
+        "tests/unprocessed/6A_DSF4294.jpg",
+        "tests/unprocessed/6.yaml",
+        "tests/unprocessed/1A_DSF3888.jpg",
+        "tests/unprocessed/manifest.json",
+    ]
+    manifest = QueueManifest(gcs, UNPROCESSED_DIR)
+    manifest.load()
+
+    assert manifest.get_lowest_id() == 1
+    assert manifest.get_max_id() == 6
+    assert manifest.get_images(6) == ["6A_DSF4294.jpg", "6B_DSF3994.jpg"]
+    assert manifest.get_config(6) == "6.yaml"
+    assert manifest.get_config(1) is None
+
+    # Rebuilding an unchanged queue writes nothing
+    writes = gcs.upload_json.call_count
+    manifest.rebuild()
+    assert gcs.upload_json.call_count == writes
+
+    gcs.download_json_blob_with_generation.return_value = (
+        {"posts": manifest.posts},
+        1,
+    )
+    manifest.remove_post(1)
+    assert manifest.get_lowest_id() == 6
+    gcs.upload_json.assert_any_call(
+        manifest.path, {"posts": manifest.posts}, if_generation_match=1
+    )
+    # Readers watching the queue are told it changed
+    assert gcs.upload_json.call_args.args[0] == manifest.marker_path
+
+
+def test_derived_image_cache(tmp_path):
+    gcs = MagicMock()
+    gcs.download_blob_if_exists.return_value = None
+    cache = DerivedImageCache(gcs, Path("test/cache"), local_dir=tmp_path)
+    key = cache.get_key("abc==", "story", 0.5625, "Rome", "Basking in the sun")
+
+    assert key == cache.get_key("abc==", "story", 0.5625, "Rome", "Basking in the sun")
+    assert key != cache.get_key("abc==", "story", 0.5625, None, None)
+    assert cache.get(key) is None
+
+    cache.put(key, b"down_sampled", b"processed")
+    gcs.upload_many.assert_called_once()
+    assert cache.get(key) == (b"down_sampled", b"processed")
+
+
+def test_json_blob_cache():
+    gcs = MagicMock()
+    gcs.download_json_blob_with_generation.return_value = (
+        {"rome": {"value": {"pk": 1}, "cached_at": 0}},
+        3,
+    )
+    cache = JsonBlobCache(gcs, Path("test/test_locations.json"), ttl=60)
+
+    # Expired entries are misses
+    assert cache.get("Rome") is None
+
+    cache.put("  Spanish Steps,  ROME ", {"pk": 2})
+    assert cache.get("spanish steps, rome") == {"pk": 2}
+    assert gcs.upload_json.call_args.kwargs["if_generation_match"] == 3
+    assert "spanish steps, rome" in gcs.upload_json.call_args.args[1]
+
+
+def test_map_concurrently_keeps_order_and_caps_workers():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def _square(item: int) -> int:
+        with lock:
+            running.append(item)
+            peak.append(len(running))
+        time.sleep(0.01 * (item % 3))
+        with lock:
+            running.remove(item)
+        return item * item
+
+    assert CloudStorageAdapter.map_concurrently(_square, range(12), 3) == [
+        item * item for item in range(12)
+    ]
+    assert max(peak) <= 3
+
+
+@patch("src.utils.rate_limit.time.sleep")
+def test_token_bucket(sleep):
+    bucket = TokenBucket(rate=0.5, burst=3)
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.acquire() == pytest.approx(2, abs=0.1)
+    sleep.assert_called_once()
+
+
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_successful_upload(gcs, get_sa):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.cl = MagicMock()
+    insta.user_id = 42
+    insta.cl.media_info.return_value.user.pk = 42
+
+    assert insta.successful_upload(pk=1234)
+    insta.cl.media_info.assert_called_once_with(1234)
+    insta.cl.user_medias.assert_not_called()
+
+
+@patch("src.utils.instagram.time.sleep")
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_successful_upload_retries_client_errors(gcs, get_sa, sleep):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.cl = MagicMock()
+    insta.user_id = 42
+    insta.cl.media_info.side_effect = ClientError()
+    insta.cl.user_medias_paginated.side_effect = [
+        ClientError(),
+        ([MagicMock(pk=1234)], None),
+    ]
+
+    assert insta.successful_upload(pk=1234)
+    assert insta.cl.user_medias_paginated.call_count == 2
+
+
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_delete_users_medias_one_at_a_time(gcs, get_sa):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.cl = MagicMock()
+    insta.cl.media_delete.side_effect = [True, False, True]
+    medias = (MagicMock(spec=Media, id=f"{pk}_42") for pk in range(3))
+
+    assert insta.delete_users_medias(medias) == 2
+    assert [call.kwargs["media_id"] for call in insta.cl.media_delete.call_args_list] == [
+        "0_42",
+        "1_42",
+        "2_42",
+    ]
+
+
+@patch("src.utils.instagram.time.sleep")
+@patch("src.utils.instagram.extract_media_v1")
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_configure_album_retries_connection_errors(gcs, get_sa, extract, sleep):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.cl = MagicMock()
+    insta.cl.album_configure.side_effect = [
+        requests.exceptions.ConnectTimeout(),
+        ClientError("Transcode not finished yet"),
+        requests.exceptions.ReadTimeout(),
+        {"media": {"pk": 1234}},
+    ]
+    insta.cl.user_medias_paginated.return_value = ([], None)
+
+    assert insta.configure_album([{"upload_id": "1"}]) == extract.return_value
+    assert insta.cl.album_configure.call_count == 4
+    # Only the timed out response could have been posted
+    insta.cl.user_medias_paginated.assert_called_once()
+
+
+@patch("src.utils.instagram.time.sleep")
+@patch("src.utils.instagram.get_current_service_account")
+@patch("src.utils.instagram.CloudStorageAdapter")
+def test_configure_album_not_repeated_after_lost_response(gcs, get_sa, sleep):
+    insta = InstagramAdapter(bucket=BUCKET, login=False)
+    insta.cl = MagicMock()
+    insta.user_id = 42
+    insta.cl.album_configure.side_effect = requests.exceptions.ReadTimeout()
+    album = MagicMock(
+        media_type=8,
+        resources=[MagicMock(), MagicMock()],
+        caption_text="Rome ",
+        taken_at=datetime.now(timezone.utc),
+    )
+    insta.cl.user_medias_paginated.return_value = ([album], None)
+
+    assert insta.configure_album([{}, {}], caption="Rome") == album
+    insta.cl.album_configure.assert_called_once()
+
+
+@pytest.mark.parametrize("age, validated", [(60, False), (2 * 60 * 60, True)])
+@pytest.mark.parametrize("attempt", [0, 1])
+@patch("src.utils.instagram.get_credentials_secret", return_value=("user", "pass"))
+@patch("src.utils.instagram.CloudStorageAdapter")
+@patch("src.utils.instagram.get_current_service_account")
+def test_session_only_saved_when_validated(
+    get_sa, gcs, get_secret, attempt, age, validated
+):
+    insta = InstagramAdapter(bucket=BUCKET, account="prod", login=False)
+    insta.project = "project"
+    insta.cl = MagicMock()
+    validated_at = time.time() - age
+    insta.gcs.download_blob_if_exists.return_value = json.dumps(
+        {"user_id": 42, "validated_at": validated_at}
+    )
+    insta.cl.account_info.return_value.pk = 42
+    insta.cl.get_settings.return_value = {}
+
+    # A retried run always checks the session
+    validated = validated or attempt > 0
+    with patch("src.utils.instagram.TASK_ATTEMPT", attempt):
+        insta.setup_connection()
+
+    assert insta.cl.account_info.called == validated
+    assert insta.gcs.upload_json.called == validated
+    if validated:
+        assert insta.gcs.upload_json.call_args.args[1]["validated_at"] > validated_at
+
+
+@patch("src.utils.instagram.CloudStorageAdapter")
+@patch("src.utils.instagram.get_current_service_account")
+def test_invalidate_session(get_sa, gcs):
+    insta = InstagramAdapter(bucket=BUCKET, account="prod", login=False)
+    insta.cl = MagicMock()
+    insta.cl.get_settings.return_value = {}
+    insta.user_id = 42
+    insta.validated_at = time.time()
+
+    insta.invalidate_session()
+
+    assert insta.gcs.upload_json.call_args.args[1] == {
+        "user_id": 42,
+        "validated_at": 0,
+    }
+
+
+@pytest.mark.parametrize(
+    "method, endpoint",
+    [
+        ("album_upload", "upload"),
+        ("album_configure", "upload"),
+        ("photo_rupload", "transfer"),
+        ("photo_upload_to_story", "upload"),
+        ("hashtag_info", "search"),
+        ("fbsearch_places", "search"),
+        ("highlight_add_stories", "write"),
+        ("media_delete", "write"),
+        ("media_info", "read"),
+    ],
+)
+def test_rate_limiter_endpoints(method, endpoint):
+    assert InstagramRateLimiter.get_endpoint(method) == endpoint
+
+
+@patch("src.utils.rate_limit.time.sleep")
+def test_rate_limiter_backs_off_when_throttled(sleep):
+    limiter = InstagramRateLimiter()
+    client = MagicMock()
+    client.media_info.side_effect = [PleaseWaitFewMinutes(), "media"]
+    cl = RateLimitedClient(client, limiter)
+
+    assert cl.media_info(1234) == "media"
+    assert client.media_info.call_count == 2
+    assert limiter.buckets["read"].rate < limiter.buckets["read"].max_rate
+
+
+def test_proxy_pool_evicts_failing_proxies():
+    pool = ProxyPool(["http://a", "http://b"])
+    for _ in range(3):
+        pool.record("http://a", False)
+
+    assert not pool.stats["http://a"].healthy(time.monotonic())
+    assert all(pool.choose() == "http://b" for _ in range(10))
+
+
+def test_proxy_pool_probes_record_latency():
+    pool = ProxyPool(["http://a", "http://b"], probe=lambda proxy: 0.2)
+    pool.probe_all()
+
+    assert all(stats.latency < 1.0 for stats in pool.stats.values())
+
+
+def test_failed_to_connect():
+    try:
+        try:
+            raise requests.exceptions.ConnectTimeout()
+        except requests.ConnectionError as e:
+            raise ClientConnectionError(f"{e}")
+    except ClientConnectionError as e:
+        assert failed_to_connect(e)
+    assert not failed_to_connect(requests.exceptions.ReadTimeout())
+    assert not failed_to_connect(ClientConnectionError())
+
+
+def test_rate_limited_client_rotates_proxy_on_failure():
+    pool = ProxyPool(["http://a", "http://b"])
+    client = MagicMock()
+    client.proxy = "http://a"
+    client.media_info.side_effect = [ClientConnectionError(), "media"]
+    cl = RateLimitedClient(client, InstagramRateLimiter(), proxy_pool=pool)
+
+    assert cl.media_info(1234) == "media"
+    client.set_proxy.assert_called_once_with("http://b")
+    assert pool.stats["http://a"].success_rate < 1.0
+
+
+@patch("src.utils.misc.get_secret_client")
+def test_secrets_fetched_once_within_ttl(get_client):
+    misc._secrets.clear()
+    client = get_client.return_value
+    client.access_secret_version.side_effect = lambda name: MagicMock(
+        payload=MagicMock(data=name.split("/")[3].encode())
+    )
+
+    assert misc.get_credentials_secret(True, "project") == ("", "password")
+    assert misc.get_credentials_secret(True, "project") == ("", "password")
+    assert client.access_secret_version.call_count == 2
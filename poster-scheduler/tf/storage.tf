@@ -2,4 +2,15 @@ resource "google_storage_bucket" "images" {
     name     = "${var.project_id}-images"
     project = var.project_id
     location = var.region
+
+    # Chunked uploads abandoned in the staging area, their sessions expire in a week
+    lifecycle_rule {
+        condition {
+            age            = 7
+            matches_prefix = ["test/staging/"]
+        }
+        action {
+            type = "Delete"
+        }
+    }
 }